@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# Only imported on Python versions with native coroutines (see middleware.py).
+from __future__ import unicode_literals, absolute_import
+from asgiref.sync import sync_to_async
+
+
+class AsyncMiddlewareMixin(object):
+    """
+    Handles requests on the event loop, without the ``sync_to_async`` thread
+    hop ``MiddlewareMixin`` does for ``process_request``, as long as
+    ``is_io_free()`` says that ``process_request`` doesn't do any I/O.
+    """
+    sync_capable = True
+    async_capable = True
+
+    async def __acall__(self, request):
+        if self.is_io_free():
+            response = self.process_request(request)
+        else:
+            response = await sync_to_async(self.process_request, thread_sensitive=True)(request)
+        if response is None:
+            response = await self.get_response(request)
+        return response
@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+from django.contrib import admin
+
+from .models import SiteDomain
+
+
+@admin.register(SiteDomain)
+class SiteDomainAdmin(admin.ModelAdmin):
+    list_display = ('domain', 'type', 'site')
+    list_filter = ('type', 'site')
+    search_fields = ('domain',)
@@ -1,8 +1,37 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals, absolute_import
+import logging
+
 from django.apps import AppConfig
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models.signals import post_migrate
+
+
+logger = logging.getLogger(__name__)
+
+
+def sync_sites(using=DEFAULT_DB_ALIAS, **kwargs):
+    if using != DEFAULT_DB_ALIAS or not getattr(settings, 'ALDRYN_SITES_SET_DOMAIN_NAME', True):
+        return
+    from .utils import set_site_names
+    set_site_names(force=True)
 
 
 class AldrynSitesConfig(AppConfig):
     name = 'aldryn_sites'
     verbose_name = "Aldryn Sites"
+    # matches the migrations, ignored before Django 3.2
+    default_auto_field = 'django.db.models.AutoField'
+
+    def ready(self):
+        # the Site table is synced on migrate, not on the first request
+        post_migrate.connect(sync_sites, sender=self)
+        reload_signal = getattr(settings, 'ALDRYN_SITES_RELOAD_SIGNAL', None)
+        if reload_signal:
+            from .loader import install_signal_handler
+            try:
+                install_signal_handler(reload_signal)
+            except ValueError:
+                # not the main thread (e.g. under mod_wsgi)
+                logger.warning('Could not install the handler for ALDRYN_SITES_RELOAD_SIGNAL outside the main thread.')
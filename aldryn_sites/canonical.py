@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+import yurl
+
+from . import parallel, utils
+
+
+class Canonicalizer(object):
+    """
+    Rewrites urls to the url ``SiteMiddleware`` would redirect them to, with
+    a compiled ``SitesRouter`` or ``SiteRouter``.
+
+    The decision for a host and scheme is only computed once and kept in
+    ``decisions`` (cleared when it has ``cache_size`` entries), so all urls
+    of a host after the first one only cost parsing the url.
+    """
+    def __init__(self, router, cache_size=100000):
+        self.router = router
+        self.cache_size = cache_size
+        self.decisions = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['decisions'] = {}
+        return state
+
+    def get_target(self, host, scheme):
+        """
+        :return: None for no redirect or the ``(scheme, host)`` to redirect to
+        """
+        key = (host, scheme)
+        try:
+            return self.decisions[key]
+        except KeyError:
+            pass
+        target = self.router.resolve_site(host, scheme)[2]
+        if len(self.decisions) >= self.cache_size:
+            self.decisions.clear()
+        self.decisions[key] = target
+        return target
+
+    def canonicalize(self, url):
+        """
+        :return: the url ``url`` redirects to, or ``url`` itself
+        """
+        parsed = yurl.URL(url)
+        if not parsed.host or parsed.is_host_ip() or parsed.is_host_ipv4():
+            # don't redirect for ips
+            return url
+        target = self.get_target(utils.normalize_host(parsed.host), parsed.scheme)
+        if target is None:
+            return url
+        scheme, host = target
+        # built like the Location of SiteMiddleware
+        port = utils.normalize_port(parsed.port, parsed.scheme)
+        return utils.build_url(scheme, host, port, parsed.full_path)
+
+    def canonicalize_many(self, urls):
+        for url in urls:
+            yield self.canonicalize(url)
+
+
+_worker_canonicalizer = None
+
+
+def _init_worker(canonicalizer):
+    global _worker_canonicalizer
+    parallel.setup_worker()
+    _worker_canonicalizer = canonicalizer
+
+
+def _canonicalize_chunk(urls):
+    return [_worker_canonicalizer.canonicalize(url) for url in urls]
+
+
+def canonicalize_urls(urls, router, processes=0, chunk_size=1000):
+    """
+    Yields the canonical url for every url in ``urls``, lazily and in
+    order. ``urls`` can be any iterable, e.g. a file with one url per line
+    (whitespace around the urls is stripped).
+
+    :param router: a ``SitesRouter`` (e.g. ``settings.ALDRYN_SITES_ROUTER``)
+                   or a ``SiteRouter``
+    :param processes: canonicalize in this many worker processes, in chunks
+                      of ``chunk_size`` urls
+    """
+    canonicalizer = Canonicalizer(router)
+    urls = (url.strip() for url in urls)
+    if processes > 1:
+        for chunk in parallel.map_chunks(
+                _canonicalize_chunk, urls, processes, chunk_size=chunk_size,
+                initializer=_init_worker, initargs=(canonicalizer,)):
+            for url in chunk:
+                yield url
+    else:
+        for url in canonicalizer.canonicalize_many(urls):
+            yield url
@@ -1,26 +1,116 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals, absolute_import
+import re
+
 from django.conf import settings  # NOQA required so settings get initialised
+from django.core.exceptions import ImproperlyConfigured
 from appconf import AppConf
-from . import utils
+from .hosts import get_allowed_hosts
+from .router import SitesRouter, get_wildcard_suffix, is_plain_host
+from . import snapshot
+
+
+try:
+    string_types = (basestring,)  # NOQA
+except NameError:
+    string_types = (str,)
+
+SITE_CONFIG_KEYS = ('name', 'domain', 'aliases', 'redirects')
+
+
+def validate_domains(domains):
+    """
+    Checks the structure of ``ALDRYN_SITES_DOMAINS`` and that all regexes
+    compile.
+    :raises ImproperlyConfigured: naming the site id and the offending entry
+    """
+    if not isinstance(domains, dict):
+        raise ImproperlyConfigured('ALDRYN_SITES_DOMAINS must be a dict of site id to site config.')
+    for site_id, site_config in domains.items():
+        if not isinstance(site_config, dict):
+            raise ImproperlyConfigured(
+                'ALDRYN_SITES_DOMAINS[{!r}] must be a dict.'.format(site_id))
+        unknown_keys = set(site_config.keys()) - set(SITE_CONFIG_KEYS)
+        if unknown_keys:
+            raise ImproperlyConfigured('ALDRYN_SITES_DOMAINS[{!r}] has unknown keys: {}.'.format(
+                site_id, ', '.join(sorted('{!r}'.format(key) for key in unknown_keys))))
+        domain = site_config.get('domain')
+        if not domain or not isinstance(domain, string_types) or not is_plain_host(domain):
+            raise ImproperlyConfigured(
+                'ALDRYN_SITES_DOMAINS[{!r}][\'domain\'] must be a domain name, got {!r}.'.format(
+                    site_id, domain))
+        name = site_config.get('name')
+        if name is not None and not isinstance(name, string_types):
+            raise ImproperlyConfigured(
+                'ALDRYN_SITES_DOMAINS[{!r}][\'name\'] must be a string, got {!r}.'.format(site_id, name))
+        for key in ('aliases', 'redirects'):
+            entries = site_config.get(key, [])
+            if not isinstance(entries, (list, tuple, set, frozenset)):
+                raise ImproperlyConfigured(
+                    'ALDRYN_SITES_DOMAINS[{!r}][{!r}] must be a list, got {!r}.'.format(site_id, key, entries))
+            for entry in entries:
+                if hasattr(entry, 'match'):
+                    # a pre-compiled regex
+                    continue
+                if not entry or not isinstance(entry, string_types):
+                    raise ImproperlyConfigured(
+                        'ALDRYN_SITES_DOMAINS[{!r}][{!r}] contains an invalid entry: {!r}.'.format(
+                            site_id, key, entry))
+                if get_wildcard_suffix(entry) is not None:
+                    continue
+                try:
+                    re.compile(entry)
+                except re.error as e:
+                    raise ImproperlyConfigured(
+                        'ALDRYN_SITES_DOMAINS[{!r}][{!r}] contains an invalid regex {!r}: {}.'.format(
+                            site_id, key, entry, e))
 
 
 class AldrynSitesConf(AppConf):
     DOMAINS = {}
     SET_DOMAIN_NAME = True
     AUTO_CONFIGURE_ALLOWED_HOSTS = True
+    DECISION_CACHE_SIZE = 0
+    MULTISITE = False
+    STATS = False
+    STATS_HOOK = None
+    VALIDATE_HOSTS = False
+    DATABASE_DOMAINS = False
+    DOMAINS_FILE = None
+    RELOAD_INTERVAL = 5
+    RELOAD_SIGNAL = None
+    ROUTER_SNAPSHOT = None
+    SITE_CACHE = None
+    REDIRECT_PERMANENT = False
+    REDIRECT_CACHE_CONTROL = None
+    REDIRECT_VARY = None
+    PATH_REDIRECTS = {}
 
-    # TODO: validate settings
+    def configure_domains(self, value):
+        validate_domains(value)
+        return value
 
     def configure(self):
+        s = self._meta.holder
         if self.configured_data['AUTO_CONFIGURE_ALLOWED_HOSTS'] and self.configured_data['DOMAINS']:
-            s = self._meta.holder
             ALLOWED_HOSTS = s.ALLOWED_HOSTS
             ah_type = type(ALLOWED_HOSTS)
-            ALLOWED_HOSTS = list(ALLOWED_HOSTS)
-            domains = utils.get_all_domains(self.configured_data['DOMAINS'])
-            for domain in domains:
-                if domain not in ALLOWED_HOSTS:
-                    ALLOWED_HOSTS.append(domain)
+            ALLOWED_HOSTS = get_allowed_hosts(self.configured_data['DOMAINS'], ALLOWED_HOSTS)
             s.ALLOWED_HOSTS = ah_type(ALLOWED_HOSTS)
+        # compile once at startup, the middleware only reads ALDRYN_SITES_ROUTER
+        https = getattr(s, 'SECURE_SSL_REDIRECT', None)
+        default_site_id = getattr(s, 'SITE_ID', 1)
+        if self.configured_data['ROUTER_SNAPSHOT']:
+            self.configured_data['ROUTER'] = snapshot.get_router(
+                self.configured_data['ROUTER_SNAPSHOT'],
+                self.configured_data['DOMAINS'],
+                https=https,
+                default_site_id=default_site_id,
+            )
+        else:
+            self.configured_data['ROUTER'] = SitesRouter(
+                self.configured_data['DOMAINS'],
+                https=https,
+                default_site_id=default_site_id,
+            )
         return self.configured_data
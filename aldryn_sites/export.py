@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+import re
+from collections import namedtuple
+
+from .router import SitesRouter, REDIRECT, ALIAS, is_plain_host
+from . import utils
+
+
+SCHEMES = ('http', 'https')
+
+NGINX = 'nginx'
+HAPROXY = 'haproxy'
+VCL = 'vcl'
+FORMATS = (NGINX, HAPROXY, VCL)
+
+EXACT = 'exact'
+WILDCARD = 'wildcard'
+REGEX = 'regex'
+
+
+class Rule(namedtuple('Rule', ['kind', 'key', 'targets'])):
+    """
+    A host (``EXACT``), wildcard suffix (``WILDCARD``, ``''`` for ``*``) or
+    regex (``REGEX``) with its redirect target per scheme. A target is None
+    for no redirect or a ``(scheme, host)`` tuple, host being None for the
+    requested host.
+    """
+    __slots__ = ()
+
+
+def get_site_routers(router):
+    if isinstance(router, SitesRouter):
+        return list(router.routers.values())
+    return [router]
+
+
+def get_targets(decide):
+    return dict((scheme, decide(scheme)[1]) for scheme in SCHEMES)
+
+
+def get_rules(router):
+    """
+    Translates the redirect rules of ``router`` (a ``SitesRouter`` or a
+    ``SiteRouter``, like ``SiteMiddleware.router``) into rules for a front
+    proxy, in the order a proxy has to check them:
+
+    * exact hosts. Hosts without a redirect are included, so they aren't
+      matched by a pattern of another site.
+    * wildcards, the most specific first. For the same suffix only the
+      wildcard ``SiteMiddleware`` would use is included. An alias wildcard
+      is preceded by the redirect regexes of its site, limited to the hosts
+      the wildcard matches.
+    * regexes, in the order ``SiteMiddleware`` checks them.
+
+    Plain host names are only exported as exact hosts. ``SiteMiddleware``
+    also matches them as prefixes (``example.com`` matches
+    ``example.com.other.org``), a proxy doesn't.
+    """
+    site_routers = get_site_routers(router)
+    routers_by_id = dict((site_router.site_id, site_router) for site_router in site_routers)
+    if isinstance(router, SitesRouter):
+        hosts = router.hosts
+    else:
+        hosts = dict.fromkeys(router.domains | router.redirect_domains, router.site_id)
+
+    rules = []
+    # regexes, which can be compiled already and don't sort with strings
+    plain_hosts = [(host, site_id) for host, site_id in hosts.items() if is_plain_host(host)]
+    for host, site_id in sorted(plain_hosts):
+        site_router = routers_by_id[site_id]
+        rules.append(Rule(EXACT, host, get_targets(
+            lambda scheme: site_router.get_decision(host, scheme))))
+
+    # lists of rules that end with a wildcard
+    wildcards = []
+    seen = set()
+    for site_router in site_routers:
+        for suffix in sorted(site_router.wildcard_suffixes):
+            if suffix in seen:
+                # the lowest site id wins
+                continue
+            seen.add(suffix)
+            tier = site_router.get_wildcard_tier(suffix)
+            group = []
+            if tier == ALIAS:
+                for pattern in site_router.patterns.get_patterns(REDIRECT):
+                    if not is_plain_host(pattern.pattern):
+                        group.append(Rule(REGEX, get_regex(pattern, suffix), get_targets(
+                            lambda scheme: site_router.get_pattern_decision(REDIRECT, None, scheme))))
+            group.append(Rule(WILDCARD, suffix, get_targets(
+                lambda scheme: site_router.get_pattern_decision(tier, None, scheme))))
+            wildcards.append(group)
+    # more labels first, ``*`` last
+    wildcards.sort(key=lambda group: (-len(group[-1].key.split('.')) if group[-1].key else 1, group[-1].key))
+    for group in wildcards:
+        rules.extend(group)
+
+    for site_router in site_routers:
+        for tier in (REDIRECT, ALIAS):
+            for pattern in site_router.patterns.get_patterns(tier):
+                if is_plain_host(pattern.pattern):
+                    continue
+                rules.append(Rule(REGEX, get_regex(pattern), get_targets(
+                    lambda scheme: site_router.get_pattern_decision(tier, None, scheme))))
+    return rules
+
+
+def get_regex(pattern, suffix=None):
+    """
+    :param suffix: only match the hosts the wildcard for ``suffix`` matches
+    :return: ``pattern`` as a regex for ``search`` (proxies don't anchor
+             regexes at the start like ``re.match``)
+    """
+    regex = pattern.pattern
+    if suffix:
+        regex = '^(?={})(?:{})'.format(get_wildcard_regex(suffix)[1:], regex)
+    elif not regex.startswith('^'):
+        regex = '^(?:{})'.format(regex)
+    if pattern.flags & re.IGNORECASE:
+        regex = '(?i)' + regex
+    return regex
+
+
+def get_wildcard_regex(suffix):
+    if not suffix:
+        return '.'
+    return r'^.+\.{}$'.format(re.escape(suffix))
+
+
+def format_target(target, host):
+    """
+    :param host: how the requested host is written in the target format
+    """
+    scheme, target_host = target
+    return '{}://{}'.format(scheme, target_host or host)
+
+
+def match(rules, host):
+    """
+    :return: the first rule ``host`` matches, with the semantics of the
+             exported configs
+    """
+    for rule in rules:
+        if rule.kind == EXACT:
+            if rule.key == host:
+                return rule
+        elif rule.kind == WILDCARD:
+            if not rule.key or host.endswith('.' + rule.key):
+                return rule
+        elif re.search(rule.key, host):
+            return rule
+    return None
+
+
+def split_nginx_rules(rules):
+    """
+    nginx checks exact names first, then wildcard masks (the longest one
+    wins) and then regexes in order, whatever the order of the lines.
+    Wildcards after the first regex are exported as regexes, so they are
+    still checked after it.
+    :return: the exact, mask and regex rules
+    """
+    exact = []
+    masks = []
+    regexes = []
+    for rule in rules:
+        if rule.kind == EXACT:
+            exact.append(rule)
+        elif rule.kind == WILDCARD and rule.key and not regexes:
+            masks.append(rule)
+        else:
+            regexes.append(rule)
+    return exact, masks, regexes
+
+
+def get_lookup_order(rules, format=None):
+    """
+    :param format: ``NGINX``, ``HAPROXY``, ``VCL`` or None for the order of
+                   ``rules``
+    :return: ``rules`` in the order the proxy checks them
+    """
+    if format == NGINX:
+        exact, masks, regexes = split_nginx_rules(rules)
+        return exact + masks + regexes
+    # HAProxy checks the map_str file before the map_reg file, VCL checks the
+    # rules in order (and they start with the exact hosts)
+    return [rule for rule in rules if rule.kind == EXACT] + [rule for rule in rules if rule.kind != EXACT]
+
+
+def verify(rules, router, hosts, format=None):
+    """
+    Checks ``rules``, in the order the proxy for ``format`` checks them (see
+    ``get_lookup_order``), against ``router`` for every host in ``hosts``
+    and both schemes. IP addresses are skipped, as ``SiteMiddleware``
+    doesn't redirect them.
+    :return: a list of ``(host, scheme, expected, got)`` tuples of the
+             differences, with the targets as urls or None
+    """
+    rules = get_lookup_order(rules, format)
+    exact = dict((rule.key, rule) for rule in rules if rule.kind == EXACT)
+    patterns = [rule for rule in rules if rule.kind != EXACT]
+    differences = []
+    for host in hosts:
+        if utils.is_ip_address(host):
+            continue
+        rule = exact.get(host) or match(patterns, host)
+        for scheme in SCHEMES:
+            expected = router.resolve_site(host, scheme)[2]
+            got = rule.targets[scheme] if rule is not None else None
+            expected = format_target(expected, host) if expected else None
+            got = format_target(got, host) if got else None
+            if expected != got:
+                differences.append((host, scheme, expected, got))
+    return differences
+
+
+def render_nginx(rules, status=302):
+    """
+    :return: ``map`` blocks setting ``$aldryn_sites_redirect``, with the rules
+             in the order nginx checks them (see ``split_nginx_rules``)
+    """
+    exact, masks, regexes = split_nginx_rules(rules)
+    lines = [
+        '# generated by aldryn-sites, use in a server block:',
+        '#     if ($aldryn_sites_redirect) {',
+        '#         return {} $aldryn_sites_redirect$request_uri;'.format(status),
+        '#     }',
+    ]
+    for scheme in SCHEMES:
+        lines.extend([
+            'map $host $aldryn_sites_{}_redirect {{'.format(scheme),
+            '    hostnames;',
+            '    default "";',
+        ])
+        for rule in exact + masks + regexes:
+            if rule.kind == EXACT:
+                key = rule.key
+            elif rule in masks:
+                key = '*.{}'.format(rule.key)
+            else:
+                regex = get_wildcard_regex(rule.key) if rule.kind == WILDCARD else rule.key
+                key = '"~{}"'.format(regex.replace('"', '\\"'))
+            target = rule.targets[scheme]
+            lines.append('    {} "{}";'.format(key, format_target(target, '$host') if target else ''))
+        lines.append('}')
+    lines.extend([
+        'map $scheme $aldryn_sites_redirect {',
+        '    default $aldryn_sites_http_redirect;',
+        '    https $aldryn_sites_https_redirect;',
+        '}',
+    ])
+    return '\n'.join(lines) + '\n'
+
+
+def render_haproxy(rules, status=302, path='/etc/haproxy'):
+    """
+    :return: a dict of file name to content: a ``map_str`` and a ``map_reg``
+             file per scheme and the frontend snippet using them. ``-`` is
+             no redirect, a target ending in ``://`` redirects to the
+             requested host.
+    """
+    files = {}
+    for scheme in SCHEMES:
+        exact = []
+        regexes = []
+        for rule in rules:
+            target = rule.targets[scheme]
+            value = format_target(target, '') if target else '-'
+            if rule.kind == EXACT:
+                exact.append('{} {}'.format(rule.key, value))
+            elif rule.kind == WILDCARD:
+                regexes.append('{} {}'.format(get_wildcard_regex(rule.key), value))
+            else:
+                regexes.append('{} {}'.format(rule.key, value))
+        files['aldryn_sites_{}.map'.format(scheme)] = '\n'.join(exact) + '\n'
+        files['aldryn_sites_{}_reg.map'.format(scheme)] = '\n'.join(regexes) + '\n'
+
+    lines = [
+        '# generated by aldryn-sites, add to the frontend',
+        'http-request set-var(txn.aldryn_sites_host) req.hdr(host),field(1,:),lower',
+    ]
+    for scheme in SCHEMES:
+        condition = '{ ssl_fc }' if scheme == 'https' else '!{ ssl_fc }'
+        lines.extend([
+            'http-request set-var(txn.aldryn_sites_redirect) '
+            'var(txn.aldryn_sites_host),map_str({}/aldryn_sites_{}.map) if {}'.format(path, scheme, condition),
+            'http-request set-var(txn.aldryn_sites_redirect) '
+            'var(txn.aldryn_sites_host),map_reg({}/aldryn_sites_{}_reg.map) if {} '
+            '!{{ var(txn.aldryn_sites_redirect) -m found }}'.format(path, scheme, condition),
+        ])
+    lines.extend([
+        'http-request redirect code {} location '
+        '%[var(txn.aldryn_sites_redirect)]%[var(txn.aldryn_sites_host)]%[capture.req.uri] '
+        'if {{ var(txn.aldryn_sites_redirect) -m end :// }}'.format(status),
+        'http-request redirect code {} location %[var(txn.aldryn_sites_redirect)]%[capture.req.uri] '
+        'if {{ var(txn.aldryn_sites_redirect) -m beg http }} '
+        '!{{ var(txn.aldryn_sites_redirect) -m end :// }}'.format(status),
+    ])
+    files['aldryn_sites.cfg'] = '\n'.join(lines) + '\n'
+    return files
+
+
+def render_vcl(rules, status=302):
+    """
+    :return: ``aldryn_sites_recv`` and ``aldryn_sites_synth`` subroutines,
+             to be called from ``vcl_recv`` and ``vcl_synth``. The scheme is
+             taken from the ``X-Forwarded-Proto`` header.
+    """
+    host = 'req.http.X-Aldryn-Sites-Host'
+    lines = [
+        '# generated by aldryn-sites, requires "import std;"',
+        'sub aldryn_sites_recv {',
+        '    set {} = std.tolower(regsub(req.http.host, ":[0-9]+$", ""));'.format(host),
+    ]
+    for index, scheme in enumerate(SCHEMES):
+        if index == 0:
+            lines.append('    if (req.http.X-Forwarded-Proto != "https") {')
+        else:
+            lines.append('    } else {')
+        keyword = 'if'
+        for rule in rules:
+            if rule.kind == EXACT:
+                condition = '{} == "{}"'.format(host, rule.key)
+            elif rule.kind == WILDCARD:
+                condition = '{} ~ {{"{}"}}'.format(host, get_wildcard_regex(rule.key))
+            else:
+                condition = '{} ~ {{"{}"}}'.format(host, rule.key)
+            lines.append('        {} ({}) {{'.format(keyword, condition))
+            target = rule.targets[scheme]
+            if target is not None:
+                if target[1] is None:
+                    location = '"{}://" + {}'.format(target[0], host)
+                else:
+                    location = '"{}"'.format(format_target(target, None))
+                lines.append('            set req.http.X-Aldryn-Sites-Location = {};'.format(location))
+            keyword = '} elsif'
+        if rules:
+            lines.append('        }')
+    lines.extend([
+        '    }',
+        '    if (req.http.X-Aldryn-Sites-Location) {',
+        '        return (synth(750));',
+        '    }',
+        '}',
+        'sub aldryn_sites_synth {',
+        '    if (resp.status == 750) {',
+        '        set resp.http.Location = req.http.X-Aldryn-Sites-Location + req.url;',
+        '        set resp.status = {};'.format(status),
+        '        return (deliver);',
+        '    }',
+        '}',
+    ])
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+import re
+
+from .router import WildcardTrie, get_wildcard_suffix, is_plain_host
+from .utils import get_normalized_host
+
+
+# regexes that allow any subdomain of a fixed domain, like
+# r'^.+\.example\.com$'. Regexes that only allow some subdomains (e.g. a
+# single label with ``[a-z0-9-]+``) or hosts that only start with the domain
+# (without ``$``) would be widened by ``.example.com``.
+_SUBDOMAIN_REGEX = re.compile(
+    r'^\^?\.\+'
+    r'\\\.((?:[a-z0-9-]+\\\.)*[a-z0-9-]+)\$$'
+)
+
+
+def get_allowed_host(entry):
+    """
+    Translates an entry of ``ALDRYN_SITES_DOMAINS`` to the form of
+    ``ALLOWED_HOSTS``. Wildcards and regexes for any subdomain
+    (``'^.+\\.example\\.com$'``) become ``.example.com`` (which Django also
+    matches against ``example.com``).
+    :return: the entry for ``ALLOWED_HOSTS``, or None if it can't be
+             translated
+    """
+    if hasattr(entry, 'match'):
+        entry = entry.pattern
+    suffix = get_wildcard_suffix(entry)
+    if suffix is not None:
+        return '.{}'.format(get_normalized_host(suffix)) if suffix else '*'
+    match = _SUBDOMAIN_REGEX.match(entry)
+    if match:
+        return '.{}'.format(match.group(1).replace('\\.', '.'))
+    if is_plain_host(entry):
+        return get_normalized_host(entry)
+    return None
+
+
+def get_allowed_hosts(domains, allowed_hosts=()):
+    """
+    :return: ``allowed_hosts`` followed by all entries of ``domains`` (see
+             ``get_allowed_host``) not in there yet
+    """
+    seen = set(allowed_hosts)
+    hosts = list(allowed_hosts)
+    for site_config in domains.values():
+        entries = [site_config['domain']]
+        entries.extend(site_config.get('aliases', []))
+        entries.extend(site_config.get('redirects', []))
+        for entry in entries:
+            host = get_allowed_host(entry)
+            if host is not None and host not in seen:
+                seen.add(host)
+                hosts.append(host)
+    return hosts
+
+
+class HostValidator(object):
+    """
+    Checks hosts against all sites of a ``SitesRouter`` and ``ALLOWED_HOSTS``.
+
+    Exact hosts are checked with a set lookup and wildcards with a trie, only
+    hosts that match neither are checked against the regexes of each site
+    (see ``SitesRouter.find_host_site_id``). Host names and regexes have to
+    match the whole host: unlike redirects, ``example.com`` doesn't allow
+    ``example.com.other.org``. Unlike Django's check of ``ALLOWED_HOSTS``,
+    the cost doesn't grow with the number of domains.
+
+    ``host`` has to be normalized and pass Django's syntax check
+    (``django.http.request.split_domain_port``) first.
+
+    ``'*'`` in ``allowed_hosts`` is ignored, so Django's own check can be
+    short-circuited with ``ALLOWED_HOSTS = ['*', ...]``.
+    """
+    def __init__(self, router, allowed_hosts=()):
+        self.router = router
+        self.hosts = set()
+        self.wildcards = WildcardTrie()
+        for allowed_host in allowed_hosts:
+            allowed_host = allowed_host.lower()
+            if allowed_host == '*':
+                continue
+            if allowed_host.startswith('.'):
+                # Django matches the domain itself and all its subdomains
+                self.hosts.add(allowed_host[1:])
+                self.wildcards.add(allowed_host[1:], True)
+            else:
+                self.hosts.add(allowed_host)
+
+    def __call__(self, host):
+        if host in self.hosts:
+            return True
+        if self.wildcards and self.wildcards.match(host):
+            return True
+        return self.router.find_host_site_id(host) is not None
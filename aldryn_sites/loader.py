@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+import json
+import logging
+import os
+import signal
+import threading
+import time
+import weakref
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+
+from .router import SitesRouter
+
+
+logger = logging.getLogger(__name__)
+
+VERSION_CACHE_KEY = 'aldryn_sites:domains_version'
+
+# all loaders of this process, for reload()
+_loaders = weakref.WeakSet()
+
+
+def get_domains_version():
+    return cache.get(VERSION_CACHE_KEY)
+
+
+def bump_domains_version():
+    """
+    Tells all processes to rebuild their router from the database.
+    """
+    try:
+        cache.incr(VERSION_CACHE_KEY)
+    except ValueError:
+        # not set yet (or evicted)
+        cache.set(VERSION_CACHE_KEY, int(time.time() * 1000), None)
+
+
+def get_domains(domains=None):
+    """
+    :return: a copy of ``domains`` (default: ``settings.ALDRYN_SITES_DOMAINS``)
+             extended with the aliases and redirects in the database. Sites
+             that are only in the database use ``Site.domain`` as domain.
+    """
+    from .models import SiteDomain
+
+    if domains is None:
+        domains = settings.ALDRYN_SITES_DOMAINS
+    # the lists are replaced, not changed, so copying the site configs is
+    # enough (pre-compiled regexes can't be copied on all Python versions)
+    domains = dict((site_id, dict(site_config)) for site_id, site_config in domains.items())
+    site_domains = SiteDomain.objects.select_related('site').order_by('site_id', 'pk')
+    for site_domain in site_domains:
+        site_config = domains.setdefault(site_domain.site_id, {'domain': site_domain.site.domain})
+        key = 'redirects' if site_domain.type == SiteDomain.REDIRECT else 'aliases'
+        site_config[key] = list(site_config.get(key, [])) + [site_domain.domain]
+    return domains
+
+
+def load_domains_file(path):
+    """
+    Loads domains in the format of ``ALDRYN_SITES_DOMAINS`` from a json or
+    (if PyYAML is installed) yaml file.
+    """
+    with open(path) as f:
+        content = f.read()
+    if path.endswith(('.yaml', '.yml')):
+        try:
+            import yaml
+        except ImportError:
+            raise ImproperlyConfigured('PyYAML is required to load {}.'.format(path))
+        domains = yaml.safe_load(content)
+    else:
+        domains = json.loads(content)
+    if not isinstance(domains, dict):
+        raise ImproperlyConfigured('{} must contain a mapping of site id to site config.'.format(path))
+    # json only has string keys
+    return {
+        int(site_id) if '{}'.format(site_id).isdigit() else site_id: site_config
+        for site_id, site_config in domains.items()
+    }
+
+
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+class RouterLoader(object):
+    """
+    Keeps the ``SitesRouter`` of a process up to date.
+
+    The domains come from ``domains`` or the file at ``path``, extended with
+    the database (see ``get_domains``) if ``database`` is set. At most every
+    ``interval`` seconds ``get_router`` checks whether the file changed or
+    the version counter in the Django cache was bumped, the database is only
+    queried if it was.
+
+    A new router is built completely before it replaces the current one (a
+    single attribute assignment), so requests never see a half-built router.
+    Changes to the file are loaded in a background thread. If a reload
+    fails, the current router is kept.
+    """
+    def __init__(self, domains, https=None, default_site_id=None, interval=5, database=False, path=None,
+                 router=None):
+        self.domains = domains
+        self.https = https
+        self.default_site_id = default_site_id
+        self.interval = interval
+        self.database = database
+        self.path = path
+        self.router = router
+        self.version = get_domains_version() if database and router is not None else None
+        self.mtime = get_mtime(path) if path and router is not None else None
+        self.checked = time.time()
+        self.reloading = None
+        self._lock = threading.Lock()
+        _loaders.add(self)
+
+    def load_domains(self):
+        from .conf import validate_domains
+
+        domains = load_domains_file(self.path) if self.path else self.domains
+        if self.database:
+            domains = get_domains(domains)
+        validate_domains(domains)
+        return domains
+
+    def reload(self):
+        """
+        Builds a new router and swaps it in.
+        """
+        with self._lock:
+            version = get_domains_version() if self.database else None
+            mtime = get_mtime(self.path) if self.path else None
+            try:
+                router = SitesRouter(self.load_domains(), https=self.https, default_site_id=self.default_site_id)
+            finally:
+                # a broken config is not retried until it changes again
+                self.version = version
+                self.mtime = mtime
+                self.checked = time.time()
+            self.router = router
+        return router
+
+    def reload_safely(self):
+        try:
+            self.reload()
+        except Exception:
+            logger.exception('Could not reload the domains, keeping the current redirect rules.')
+
+    def reload_in_background(self):
+        if self.reloading is not None and self.reloading.is_alive():
+            return self.reloading
+        self.reloading = threading.Thread(target=self._background_reload, name='aldryn-sites-reload')
+        self.reloading.daemon = True
+        self.reloading.start()
+        return self.reloading
+
+    def _background_reload(self):
+        try:
+            self.reload_safely()
+        finally:
+            if self.database:
+                # the thread got its own database connection
+                connection.close()
+
+    def is_stale(self):
+        if self.database and get_domains_version() != self.version:
+            return True
+        if self.path and get_mtime(self.path) != self.mtime:
+            return True
+        return False
+
+    def get_router(self):
+        if self.router is None:
+            self.reload_safely()
+            if self.router is None:
+                # e.g. an invalid row in the database, start with the settings
+                self.router = SitesRouter(self.domains, https=self.https, default_site_id=self.default_site_id)
+            return self.router
+        if not (self.database or self.path):
+            return self.router
+        now = time.time()
+        if now - self.checked < self.interval:
+            return self.router
+        self.checked = now
+        if self.is_stale():
+            if self.database:
+                # same thread, so it sees the same database (transaction)
+                self.reload_safely()
+            else:
+                self.reload_in_background()
+        return self.router
+
+
+def get_middleware_router(path=None):
+    """
+    Builds the router ``SiteMiddleware`` uses with the current settings, for
+    tools that run outside of a request.
+    :param path: a domains file to use instead of ``ALDRYN_SITES_DOMAINS_FILE``
+    :return: the ``SitesRouter`` with ``ALDRYN_SITES_MULTISITE``, otherwise
+             the ``SiteRouter`` of ``SITE_ID`` (None if it isn't configured)
+    """
+    site_id = getattr(settings, 'SITE_ID', 1)
+    sites_router = RouterLoader(
+        settings.ALDRYN_SITES_DOMAINS,
+        https=getattr(settings, 'SECURE_SSL_REDIRECT', None),
+        default_site_id=site_id,
+        database=getattr(settings, 'ALDRYN_SITES_DATABASE_DOMAINS', False),
+        path=path or getattr(settings, 'ALDRYN_SITES_DOMAINS_FILE', None),
+    ).reload()
+    if getattr(settings, 'ALDRYN_SITES_MULTISITE', False):
+        return sites_router
+    return sites_router.routers.get(site_id)
+
+
+def reload(background=False):
+    """
+    Rebuilds the routers of all ``SiteMiddleware`` instances in this process.
+    Errors are logged and the current routers are kept.
+    """
+    for loader in list(_loaders):
+        if background:
+            loader.reload_in_background()
+        else:
+            loader.reload_safely()
+
+
+def install_signal_handler(signum):
+    """
+    Reloads the routers in the background when the process receives
+    ``signum`` (a number or a name like ``'SIGUSR1'``).
+    :raises ValueError: if not called from the main thread
+    """
+    if not isinstance(signum, int):
+        signum = getattr(signal, signum)
+    signal.signal(signum, lambda signum, frame: reload(background=True))
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+import io
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import export
+from ...loader import get_middleware_router
+
+
+class Command(BaseCommand):
+    help = 'Exports the redirects of ALDRYN_SITES_DOMAINS as nginx maps, HAProxy maps or VCL.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'format',
+            nargs='?',
+            choices=export.FORMATS,
+            help='Required unless --verify is given, which checks all formats without it.',
+        )
+        parser.add_argument(
+            '--output-dir',
+            dest='output_dir',
+            help='Write the files to this directory instead of printing them.',
+        )
+        parser.add_argument(
+            '--haproxy-path',
+            dest='haproxy_path',
+            default='/etc/haproxy',
+            help='The directory HAProxy loads the map files from.',
+        )
+        parser.add_argument(
+            '--verify',
+            dest='verify',
+            metavar='HOSTS_FILE',
+            help='Check the exported rules against SiteMiddleware for the hosts in this file (one per line).',
+        )
+
+    def get_router(self):
+        """
+        :return: the router ``SiteMiddleware`` uses
+        """
+        router = get_middleware_router()
+        if router is None:
+            raise CommandError('SITE_ID {} is not in ALDRYN_SITES_DOMAINS.'.format(getattr(settings, 'SITE_ID', 1)))
+        return router
+
+    def handle(self, *args, **options):
+        router = self.get_router()
+        rules = export.get_rules(router)
+
+        if options['verify']:
+            with io.open(options['verify'], encoding='utf-8') as f:
+                hosts = [line.strip().lower() for line in f if line.strip() and not line.startswith('#')]
+            differences = 0
+            for export_format in [options['format']] if options['format'] else export.FORMATS:
+                format_differences = export.verify(rules, router, hosts, export_format)
+                for host, scheme, expected, got in format_differences:
+                    self.stdout.write('{} {}://{}: expected {}, got {}'.format(
+                        export_format, scheme, host, expected, got))
+                differences += len(format_differences)
+            if differences:
+                raise CommandError('{} differences in {} hosts.'.format(differences, len(hosts)))
+            self.stdout.write('{} hosts verified.'.format(len(hosts)))
+            return
+        if not options['format']:
+            raise CommandError('Give a format to export ({}).'.format(', '.join(export.FORMATS)))
+
+        status = 301 if getattr(settings, 'ALDRYN_SITES_REDIRECT_PERMANENT', False) else 302
+        if options['format'] == export.NGINX:
+            files = {'aldryn_sites.conf': export.render_nginx(rules, status=status)}
+        elif options['format'] == export.HAPROXY:
+            files = export.render_haproxy(rules, status=status, path=options['haproxy_path'])
+        else:
+            files = {'aldryn_sites.vcl': export.render_vcl(rules, status=status)}
+
+        for name, content in sorted(files.items()):
+            if options['output_dir']:
+                with io.open(os.path.join(options['output_dir'], name), 'w', encoding='utf-8') as f:
+                    f.write(content)
+            else:
+                if len(files) > 1:
+                    self.stdout.write('# {}'.format(name))
+                self.stdout.write(content, ending='')
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import replay
+from ...loader import get_middleware_router
+
+
+class Command(BaseCommand):
+    help = 'Replays access logs through the redirect rules of SiteMiddleware and reports how they are used.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('logs', nargs='+', metavar='LOG', help='Access logs, gzipped or not. - reads stdin.')
+        parser.add_argument(
+            '--format',
+            dest='log_format',
+            choices=('auto', replay.COMBINED, replay.PLAIN),
+            default='auto',
+            help='combined (optionally with a vhost or a trailing "host" field) or plain "host scheme path" lines.',
+        )
+        parser.add_argument(
+            '--scheme',
+            dest='scheme',
+            default='http',
+            help='The scheme of requests the log has no scheme for.',
+        )
+        parser.add_argument(
+            '--domains',
+            dest='domains',
+            metavar='DOMAINS_FILE',
+            help='Replay a proposed config (a json or yaml domains file) and compare it to the current one.',
+        )
+        parser.add_argument(
+            '--workers',
+            dest='workers',
+            type=int,
+            default=0,
+            help='Replay in this many processes.',
+        )
+        parser.add_argument(
+            '--top',
+            dest='top',
+            type=int,
+            default=20,
+            help='How many hosts and differences to show.',
+        )
+
+    def get_router(self, path=None):
+        router = get_middleware_router(path)
+        if router is None:
+            raise CommandError('SITE_ID {} is not in the domains.'.format(getattr(settings, 'SITE_ID', 1)))
+        return router
+
+    def iter_lines(self, paths):
+        for path in paths:
+            with replay.open_log(path) as f:
+                for line in f:
+                    yield line
+
+    def handle(self, *args, **options):
+        if options['domains']:
+            replayer = replay.Replayer(
+                self.get_router(options['domains']),
+                current=self.get_router(),
+                log_format=None if options['log_format'] == 'auto' else options['log_format'],
+                default_scheme=options['scheme'],
+            )
+        else:
+            replayer = replay.Replayer(
+                self.get_router(),
+                log_format=None if options['log_format'] == 'auto' else options['log_format'],
+                default_scheme=options['scheme'],
+            )
+        lines = self.iter_lines(options['logs'])
+        if options['workers'] > 1:
+            report = replay.replay_parallel(replayer, lines, options['workers'])
+        else:
+            report = replayer.replay(lines)
+        self.write_report(replayer, report, options['top'])
+
+    def write_report(self, replayer, report, top):
+        write = self.stdout.write
+        write('{} requests, {} lines skipped.'.format(report.requests, report.skipped))
+        if report.requests:
+            write('Resolver time: {:.3f}s in total, {:.2f}us per request.'.format(
+                report.duration, report.duration / report.requests * 1e6))
+        write('')
+        write('Decisions per branch:')
+        for branch, count in sorted(report.branches.items(), key=lambda item: -item[1]):
+            if count:
+                write('  {:<24} {:>10} {:>6.1%}'.format(branch, count, count / float(report.requests)))
+        regex_requests = sum(report.regex_hosts.values())
+        write('')
+        write('{} requests for {} hosts fell through to the regexes:'.format(
+            regex_requests, len(report.regex_hosts)))
+        for host, count in report.regex_hosts.most_common(top):
+            write('  {:<48} {:>10}'.format(host, count))
+        unused = replayer.get_unused_rules(report)
+        write('')
+        write('{} of {} rules were never hit:'.format(len(unused), len(replayer.rules)))
+        for rule in unused:
+            write('  {:<8} {}'.format(rule.kind, rule.key or '*'))
+        if replayer.current is not None:
+            write('')
+            write('{} requests would be redirected differently:'.format(report.changed))
+            for (host, scheme, current, proposed), count in report.deltas.most_common(top):
+                write('  {}://{}: {} -> {} ({})'.format(
+                    scheme, host, current or 'no redirect', proposed or 'no redirect', count))
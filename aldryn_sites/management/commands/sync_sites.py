@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+from django.core.management.base import BaseCommand
+
+from ... import utils
+
+
+class Command(BaseCommand):
+    help = 'Creates and updates the Site table from ALDRYN_SITES_DOMAINS.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            dest='dry_run',
+            default=False,
+            help='Only show the changes, do not save them.',
+        )
+
+    def handle(self, *args, **options):
+        if options['dry_run']:
+            created, updated = utils.sync_sites(dry_run=True)
+        else:
+            result = utils.sync_sites_once()
+            if result is None:
+                self.stdout.write('Another process is syncing the sites, skipped.')
+                return
+            created, updated = result
+        for site in created:
+            self.stdout.write('+ {} {} ({})'.format(site.pk, site.domain, site.name))
+        for site in updated:
+            self.stdout.write('~ {} {}'.format(site.pk, site.domain))
+        if options['dry_run']:
+            self.stdout.write('{} sites to create, {} to update.'.format(len(created), len(updated)))
+        else:
+            self.stdout.write('{} sites created, {} updated.'.format(len(created), len(updated)))
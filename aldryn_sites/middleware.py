@@ -1,17 +1,51 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals, absolute_import
+import time
+from collections import namedtuple
+
 from django.conf import settings
-from django.shortcuts import redirect
+from django.contrib.sites.models import Site
+from django.http import HttpResponseBadRequest, HttpResponsePermanentRedirect, HttpResponseRedirect
+from django.http.request import split_domain_port
+from django.utils.functional import SimpleLazyObject
+from django.utils.module_loading import import_string
 
 try:
     from django.utils.deprecation import MiddlewareMixin
 except ImportError:
     class MiddlewareMixin(object): pass  # NOQA
 
+try:
+    from asyncio import iscoroutinefunction
+    from ._async import AsyncMiddlewareMixin
+except (ImportError, SyntaxError):
+    # Python < 3.5
+    iscoroutinefunction = None
+
+    class AsyncMiddlewareMixin(object): pass  # NOQA
+
 from . import utils
+from .cache import LRUCache, MISSING
+from .conf import string_types
+from .hosts import HostValidator
+from .loader import RouterLoader
+from .paths import load_path_redirects
+from .router import SitesRouter, IP
+from .stats import Stats
+
+timer = time.perf_counter if hasattr(time, 'perf_counter') else time.time
 
 
-class SiteMiddleware(MiddlewareMixin):
+class RouterState(namedtuple('RouterState', 'sites_router router decision_cache host_validator')):
+    """
+    Everything that is built from a ``SitesRouter``. It is replaced as a
+    whole in a single assignment, so a request never mixes the decision
+    cache of one router with another router.
+    """
+    __slots__ = ()
+
+
+class SiteMiddleware(AsyncMiddlewareMixin, MiddlewareMixin):
     """
     Redirects any alias domains to the main domain.
 
@@ -23,26 +57,259 @@ class SiteMiddleware(MiddlewareMixin):
     in MIDDLEWARE_CLASSES, so it can prevent the redirect from an alias
     domain to it's https version by djangosecure.middleware.SecurityMiddleware,
     because you might only cover the main domain with the certificate.
+
+    If ALDRYN_SITES_DECISION_CACHE_SIZE is set, redirect decisions are cached
+    per (host, scheme, https) in a bounded LRU cache (``decision_cache``),
+    including the decision not to redirect unknown hosts.
+
+    If ALDRYN_SITES_MULTISITE is set, the site is looked up by the requested
+    host across all sites in ALDRYN_SITES_DOMAINS instead of using SITE_ID
+    (which is still used for unknown hosts). The resolved site is available as
+    ``request.site_id`` and ``request.site``.
+
+    If ALDRYN_SITES_VALIDATE_HOSTS is set, the host is checked against all
+    domains in ALDRYN_SITES_DOMAINS and ALLOWED_HOSTS with a
+    ``aldryn_sites.hosts.HostValidator`` and unknown hosts get a 400 response.
+
+    If ALDRYN_SITES_STATS is set, every decision is counted and timed in
+    ``stats`` (see ``aldryn_sites.stats.Stats``). ALDRYN_SITES_STATS_HOOK is
+    the dotted path to a callable that gets every decision.
+
+    The redirect rules can be reloaded without a restart (see
+    ``aldryn_sites.loader.RouterLoader``): with ``aldryn_sites.loader.reload``,
+    from the file in ALDRYN_SITES_DOMAINS_FILE when it changes or, if
+    ALDRYN_SITES_DATABASE_DOMAINS is set, when the aliases and redirects of
+    ``aldryn_sites.models.SiteDomain`` change.
+
+    ALDRYN_SITES_PATH_REDIRECTS maps site ids to files of old paths and the
+    paths to redirect them to (see ``aldryn_sites.paths.PathRedirects``).
+
+    Redirects are permanent if ALDRYN_SITES_REDIRECT_PERMANENT is set.
+    Permanent redirects get the Cache-Control header in
+    ALDRYN_SITES_REDIRECT_CACHE_CONTROL and the Vary header in
+    ALDRYN_SITES_REDIRECT_VARY, so they can be cached by a CDN.
+
+    Under ASGI (Django >= 3.1) requests are handled on the event loop, as
+    redirect decisions don't do any I/O (except with
+    ALDRYN_SITES_DATABASE_DOMAINS).
     """
+    state = RouterState(None, None, None, None)
+    decision_cache_size = 0
+    multisite = False
+    stats = None
+    validate_hosts = False
+    loader = None
+    path_redirects = None
+    redirect_permanent = False
+    redirect_headers = ()
+
     def __init__(self, *args, **kwargs):
         self.domains = settings.ALDRYN_SITES_DOMAINS
         self.secure_redirect = getattr(settings, 'SECURE_SSL_REDIRECT', None)
         self.site_id = getattr(settings, 'SITE_ID', 1)
-        utils.set_site_names()
+        self.multisite = getattr(settings, 'ALDRYN_SITES_MULTISITE', False)
+        self.validate_hosts = getattr(settings, 'ALDRYN_SITES_VALIDATE_HOSTS', False)
+        self.decision_cache_size = getattr(settings, 'ALDRYN_SITES_DECISION_CACHE_SIZE', 0)
+        self.redirect_permanent = getattr(settings, 'ALDRYN_SITES_REDIRECT_PERMANENT', False)
+        self.redirect_headers = self.get_redirect_headers()
+        self.path_redirects = dict(
+            (site_id, load_path_redirects(path))
+            for site_id, path in getattr(settings, 'ALDRYN_SITES_PATH_REDIRECTS', {}).items()
+        )
+        path = getattr(settings, 'ALDRYN_SITES_DOMAINS_FILE', None)
+        database = getattr(settings, 'ALDRYN_SITES_DATABASE_DOMAINS', False)
+        self.loader = RouterLoader(
+            self.domains,
+            https=self.secure_redirect,
+            default_site_id=self.site_id,
+            interval=getattr(settings, 'ALDRYN_SITES_RELOAD_INTERVAL', 5),
+            database=database,
+            path=path,
+            # with the database, the router is loaded on the first request
+            router=None if (path or database) else self.get_sites_router(),
+        )
+        if not database:
+            self.set_router(self.loader.get_router())
+        if getattr(settings, 'ALDRYN_SITES_STATS', False):
+            hook = getattr(settings, 'ALDRYN_SITES_STATS_HOOK', None)
+            self.stats = Stats(hook=import_string(hook) if hook else None)
         super(SiteMiddleware, self).__init__(*args, **kwargs)
+        # the Site table is synced on migrate (or with the sync_sites
+        # command), a worker only takes the synced sites from the shared cache
+        # or loads them with one query
+        if not utils.prewarm_site_cache_from_shared_cache():
+            utils.prewarm_site_cache_from_database()
 
-    def process_request(self, request):
-        if self.site_id not in self.domains.keys():
-            return
-
-        current_url = request.build_absolute_uri()
-        site_config = self.domains[self.site_id]
-        redirect_url = utils.get_redirect_url(
-            current_url,
-            config=site_config,
-            https=self.secure_redirect,
+    def get_redirect_headers(self):
+        """
+        :return: the headers to add to redirects, as ``(name, value)`` tuples
+        """
+        if not self.redirect_permanent:
+            # temporary redirects shouldn't end up in shared caches
+            return ()
+        headers = []
+        cache_control = getattr(settings, 'ALDRYN_SITES_REDIRECT_CACHE_CONTROL', None)
+        if cache_control:
+            headers.append(('Cache-Control', cache_control))
+        vary = getattr(settings, 'ALDRYN_SITES_REDIRECT_VARY', None)
+        if vary:
+            headers.append(('Vary', vary if isinstance(vary, string_types) else ', '.join(vary)))
+        return tuple(headers)
+
+    def is_async(self):
+        get_response = getattr(self, 'get_response', None)
+        return bool(iscoroutinefunction and get_response and iscoroutinefunction(get_response))
+
+    def is_io_free(self):
+        """
+        Whether process_request can run on the event loop.
+        """
+        return self.loader is None or not self.loader.database
+
+    def get_sites_router(self):
+        """
+        :return: the router compiled at startup (ALDRYN_SITES_ROUTER), unless
+                 the settings changed since (e.g. in tests)
+        """
+        router = getattr(settings, 'ALDRYN_SITES_ROUTER', None)
+        if router is None or not router.is_built_from(self.domains, self.secure_redirect, self.site_id):
+            router = SitesRouter(self.domains, https=self.secure_redirect, default_site_id=self.site_id)
+        return router
+
+    def build_router(self, router=None):
+        if router is None:
+            router = self.get_sites_router()
+        if self.multisite:
+            return router
+        return router.routers.get(self.site_id)
+
+    @property
+    def sites_router(self):
+        return self.state.sites_router
+
+    @property
+    def router(self):
+        return self.state.router
+
+    @property
+    def decision_cache(self):
+        return self.state.decision_cache
+
+    @property
+    def host_validator(self):
+        return self.state.host_validator
+
+    def set_router(self, sites_router):
+        """
+        Switches to a new router. Requests that are already running keep
+        using the old one.
+        :return: the new ``RouterState``
+        """
+        self.state = state = RouterState(
+            sites_router,
+            self.build_router(sites_router),
+            # a new cache, only used together with the new router
+            LRUCache(self.decision_cache_size) if self.decision_cache_size else None,
+            HostValidator(sites_router, settings.ALLOWED_HOSTS) if self.validate_hosts else None,
         )
+        return state
+
+    def refresh(self):
+        """
+        :return: the current ``RouterState``
+        """
+        state = self.state
+        if self.loader is not None:
+            sites_router = self.loader.get_router()
+            if sites_router is not state.sites_router:
+                state = self.set_router(sites_router)
+        return state
+
+    def resolve(self, host, scheme, state=None):
+        """
+        :param state: the ``RouterState`` to resolve with, the current one
+                      if None
+        :return: a ``(site_id, branch, target)`` tuple, target being None or
+                 the ``(scheme, host)`` to redirect to
+        """
+        if utils.is_ip_address(host):
+            # don't redirect for ips
+            return self.site_id, IP, None
+        if state is None:
+            state = self.state
+        if state.decision_cache is None:
+            return state.router.resolve_site(host, scheme)
+        key = (host, scheme, self.secure_redirect)
+        decision = state.decision_cache.get(key)
+        if decision is MISSING:
+            decision = state.router.resolve_site(host, scheme)
+            state.decision_cache.set(key, decision)
+        return decision
+
+    def set_site(self, request, site_id):
+        request.site_id = site_id
+        # Site.objects._get_site_by_id goes through django.contrib.sites' SITE_CACHE
+        request.site = SimpleLazyObject(lambda: Site.objects._get_site_by_id(site_id))
+
+    def process_request(self, request):
+        # read once, a reload in another thread doesn't affect this request
+        state = self.refresh()
+        # host and scheme are read straight from the request, the url is only
+        # built if there is a redirect
+        if state.host_validator is None:
+            if state.router is None:
+                return
+            host, port = utils.split_host(request.get_host())
+            host = utils.normalize_host(host)
+        else:
+            # skips the linear scan of ALLOWED_HOSTS in get_host(), but not
+            # its syntax check
+            get_raw_host = getattr(request, '_get_raw_host', None)
+            host, port = split_domain_port(get_raw_host() if get_raw_host is not None else request.get_host())
+            if not host:
+                return HttpResponseBadRequest()
+            host = utils.normalize_host(host)
+            if not state.host_validator(host):
+                return HttpResponseBadRequest()
+            if state.router is None:
+                return
+        if self.stats is None:
+            site_id, branch, target = self.resolve(host, request.scheme, state)
+        else:
+            start = timer()
+            site_id, branch, target = self.resolve(host, request.scheme, state)
+            self.stats.record(branch, host, timer() - start)
+        if self.multisite:
+            self.set_site(request, site_id)
+        path_target = None
+        if self.path_redirects:
+            path_redirects = self.path_redirects.get(site_id)
+            if path_redirects is not None:
+                path_target = path_redirects.get(request.path)
+                if path_target == request.path:
+                    # would redirect to itself
+                    path_target = None
+        if path_target is None:
+            if target is None:
+                return
+            full_path = request.get_full_path()
+        else:
+            full_path = utils.add_query_string(path_target, request.META.get('QUERY_STRING', ''))
+            if '://' in path_target:
+                return self.redirect(full_path)
+        # a host and a path redirect are done in one step
+        scheme, host = target or (request.scheme, host)
+        return self.redirect(utils.build_url(scheme, host, utils.normalize_port(port, request.scheme), full_path))
 
-        if redirect_url:
-            permanent = getattr(settings, 'ALDRYN_SITES_REDIRECT_PERMANENT', False)
-            return redirect(redirect_url, permanent=permanent)
+    def redirect(self, url):
+        """
+        Builds the redirect response directly, ``django.shortcuts.redirect``
+        would first try to reverse ``url`` as a view name.
+        """
+        if self.redirect_permanent:
+            response = HttpResponsePermanentRedirect(url)
+        else:
+            response = HttpResponseRedirect(url)
+        for header, value in self.redirect_headers:
+            response[header] = value
+        return response
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sites', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SiteDomain',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('domain', models.CharField(
+                    help_text='A domain name, a wildcard (*.example.com) or a regex.',
+                    max_length=255,
+                    verbose_name='domain',
+                )),
+                ('type', models.CharField(
+                    default='alias',
+                    max_length=10,
+                    verbose_name='type',
+                    choices=[('alias', 'alias'), ('redirect', 'redirect')],
+                )),
+                ('site', models.ForeignKey(
+                    related_name='aldryn_sites_domains',
+                    on_delete=django.db.models.deletion.CASCADE,
+                    verbose_name='site',
+                    to='sites.Site',
+                )),
+            ],
+            options={
+                'verbose_name': 'site domain',
+                'verbose_name_plural': 'site domains',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='sitedomain',
+            unique_together=set([('site', 'domain')]),
+        ),
+    ]
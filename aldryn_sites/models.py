@@ -1,3 +1,85 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals, absolute_import
+import re
+
+from django.contrib.sites.models import Site
+from django.core.exceptions import ValidationError
+from django.db import models
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+try:
+    from django.utils.translation import ugettext_lazy as _
+except ImportError:
+    # Django >= 4.0
+    from django.utils.translation import gettext_lazy as _
+
+try:
+    from django.utils.encoding import python_2_unicode_compatible
+except ImportError:
+    # Django >= 3.0
+    def python_2_unicode_compatible(cls):
+        return cls
+
 from . import conf  # NOQA required so settings get initialised
+from .router import get_wildcard_suffix
+
+
+@python_2_unicode_compatible
+class SiteDomain(models.Model):
+    """
+    An alias or redirect of a site, in addition to the ones in
+    ``ALDRYN_SITES_DOMAINS``. Only used if ``ALDRYN_SITES_DATABASE_DOMAINS``
+    is set.
+    """
+    ALIAS = 'alias'
+    REDIRECT = 'redirect'
+    TYPE_CHOICES = (
+        (ALIAS, _('alias')),
+        (REDIRECT, _('redirect')),
+    )
+
+    site = models.ForeignKey(
+        Site,
+        related_name='aldryn_sites_domains',
+        on_delete=models.CASCADE,
+        verbose_name=_('site'),
+    )
+    domain = models.CharField(
+        _('domain'),
+        max_length=255,
+        help_text=_('A domain name, a wildcard (*.example.com) or a regex.'),
+    )
+    type = models.CharField(_('type'), max_length=10, choices=TYPE_CHOICES, default=ALIAS)
+
+    class Meta:
+        unique_together = (('site', 'domain'),)
+        verbose_name = _('site domain')
+        verbose_name_plural = _('site domains')
+
+    def __str__(self):
+        return self.domain
+
+    def clean(self):
+        if get_wildcard_suffix(self.domain) is not None:
+            return
+        try:
+            re.compile(self.domain)
+        except re.error as e:
+            raise ValidationError({'domain': _('Invalid regex: %s') % e})
+
+
+@receiver(post_save, sender=SiteDomain)
+@receiver(post_delete, sender=SiteDomain)
+@receiver(post_save, sender=Site)
+@receiver(post_delete, sender=Site)
+def invalidate_domains(**kwargs):
+    from .loader import bump_domains_version
+    bump_domains_version()
+
+
+@receiver(post_save, sender=Site)
+@receiver(post_delete, sender=Site)
+def invalidate_sites(**kwargs):
+    from .utils import clear_shared_site_cache
+    clear_shared_site_cache()
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+import multiprocessing
+from collections import deque
+
+
+def iter_chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def setup_worker():
+    """
+    Sets up Django in a worker process that wasn't forked from a process
+    where it is set up already (e.g. with the spawn start method).
+    """
+    from django.apps import apps
+    if not apps.ready:
+        import django
+        django.setup()
+
+
+def map_chunks(func, items, processes, chunk_size=10000, initializer=None, initargs=()):
+    """
+    Calls ``func`` with chunks of ``items`` in ``processes`` worker
+    processes and yields the results in order.
+
+    Items are read in this process, with at most two chunks per worker in
+    flight, so memory stays bounded for any number of items. The pool is
+    terminated if the caller stops iterating early.
+    """
+    pool = multiprocessing.Pool(processes, initializer=initializer, initargs=initargs)
+    try:
+        pending = deque()
+        for chunk in iter_chunks(items, chunk_size):
+            pending.append(pool.apply_async(func, (chunk,)))
+            if len(pending) >= processes * 2:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+import csv
+import io
+import json
+from array import array
+
+from django.core.exceptions import ImproperlyConfigured
+
+try:
+    from urllib.parse import unquote
+except ImportError:
+    # Python 2
+    from urllib import unquote
+
+from .conf import string_types
+
+
+# the end of a prefix rule's source, and where the rest of the path goes in its target
+WILDCARD = '*'
+
+
+class SortedTable(object):
+    """
+    An immutable, sorted mapping of strings to strings.
+
+    Keys and values are stored UTF-8 encoded in two ``bytes`` buffers with
+    ``array`` offsets, which takes a fraction of the memory of a dict of
+    Python strings. Keys are found with a binary search, in
+    O(log n) comparisons.
+    """
+    def __init__(self, items):
+        keys = []
+        values = []
+        self.key_offsets = array('I', [0])
+        self.value_offsets = array('I', [0])
+        items = ((key.encode('utf-8'), value.encode('utf-8')) for key, value in items)
+        for key, value in sorted(items, key=lambda item: item[0]):
+            if len(keys) and keys[-1] == key:
+                # the last one wins, like in a dict
+                values[-1] = value
+                self.value_offsets[-1] = self.value_offsets[-2] + len(value)
+                continue
+            keys.append(key)
+            values.append(value)
+            self.key_offsets.append(self.key_offsets[-1] + len(key))
+            self.value_offsets.append(self.value_offsets[-1] + len(value))
+        self.keys = b''.join(keys)
+        self.values = b''.join(values)
+
+    def __len__(self):
+        return len(self.key_offsets) - 1
+
+    def get_key(self, index):
+        return self.keys[self.key_offsets[index]:self.key_offsets[index + 1]]
+
+    def get_value(self, index):
+        return self.values[self.value_offsets[index]:self.value_offsets[index + 1]].decode('utf-8')
+
+    def floor(self, key):
+        """
+        :param key: UTF-8 encoded
+        :return: the index of the largest key <= ``key``, or -1
+        """
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if key < self.get_key(middle):
+                high = middle
+            else:
+                low = middle + 1
+        return low - 1
+
+    def get(self, key, default=None):
+        encoded = key.encode('utf-8')
+        index = self.floor(encoded)
+        if index >= 0 and self.get_key(index) == encoded:
+            return self.get_value(index)
+        return default
+
+    def get_prefix(self, key):
+        """
+        :return: a ``(prefix, value)`` tuple for the longest key that is a
+                 prefix of ``key``, or None
+        """
+        encoded = key.encode('utf-8')
+        while True:
+            index = self.floor(encoded)
+            if index < 0:
+                return None
+            found = self.get_key(index)
+            if encoded.startswith(found):
+                return found.decode('utf-8'), self.get_value(index)
+            # a shorter key that is a prefix of ``key`` must also be a prefix
+            # of ``found``, so continue with their common prefix
+            length = 0
+            limit = min(len(found), len(encoded))
+            while length < limit and found[length] == encoded[length]:
+                length += 1
+            encoded = encoded[:length]
+
+
+class PathRedirects(object):
+    """
+    Redirects of old paths to new ones for a site.
+
+    Sources ending in ``*`` are prefix rules, the longest one wins. If the
+    target of a prefix rule ends in ``*`` too, the rest of the path is
+    appended to it. Exact rules win over prefix rules. Targets are paths or
+    absolute urls.
+    """
+    def __init__(self, rules):
+        exact = []
+        prefixes = []
+        for source, target in rules:
+            source = unquote(source)
+            if source.endswith(WILDCARD):
+                prefixes.append((source[:-1], target))
+            else:
+                exact.append((source, target))
+        self.exact = SortedTable(exact)
+        self.prefixes = SortedTable(prefixes)
+
+    def __len__(self):
+        return len(self.exact) + len(self.prefixes)
+
+    def get(self, path):
+        """
+        :return: the target for ``path``, or None
+        """
+        target = self.exact.get(path)
+        if target is not None:
+            return target
+        if not len(self.prefixes):
+            return None
+        match = self.prefixes.get_prefix(path)
+        if match is None:
+            return None
+        prefix, target = match
+        if target.endswith(WILDCARD):
+            return target[:-1] + path[len(prefix):]
+        return target
+
+
+def check_rule(rule, path, location):
+    """
+    :return: the source and the target of ``rule``
+    :raises ImproperlyConfigured: if ``rule`` doesn't start with a source and
+                                  a target
+    """
+    if (
+        isinstance(rule, (list, tuple)) and len(rule) >= 2 and
+        all(value and isinstance(value, string_types) for value in rule[:2])
+    ):
+        return rule[0], rule[1]
+    raise ImproperlyConfigured(
+        'ALDRYN_SITES_PATH_REDIRECTS file {}, {}: expected a source and a target, got {!r}.'.format(
+            path, location, rule))
+
+
+def load_path_redirects(path):
+    """
+    Loads ``PathRedirects`` from a csv file with ``source,target`` rows
+    (lines starting with ``#`` are skipped) or a json file with an object
+    of source to target or a list of ``[source, target]`` pairs.
+    :raises ImproperlyConfigured: for a row or pair without a source and a
+                                  target, naming the file and the line
+    """
+    rules = []
+    with io.open(path, encoding='utf-8') as f:
+        if path.endswith('.json'):
+            entries = json.load(f)
+            if isinstance(entries, dict):
+                entries = entries.items()
+            for index, rule in enumerate(entries):
+                rules.append(check_rule(rule, path, 'entry {}'.format(index)))
+        else:
+            reader = csv.reader(f)
+            for row in reader:
+                if not row or row[0].startswith('#'):
+                    continue
+                rules.append(check_rule(row, path, 'line {}'.format(reader.line_num)))
+    return PathRedirects(rules)
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+import gzip
+import io
+import re
+import sys
+import time
+from collections import Counter
+
+from . import export, parallel, utils
+from .router import ALIAS, BRANCHES, IP, REDIRECT, SitesRouter
+
+timer = time.perf_counter if hasattr(time, 'perf_counter') else time.time
+
+COMBINED = 'combined'
+PLAIN = 'plain'
+
+# the combined log format, optionally with a leading ``host:port`` (Apache's
+# vhost_combined) or a trailing ``"host"`` field (e.g. nginx with ``"$host"``)
+COMBINED_LINE = re.compile(
+    r'^(?:(?P<vhost>[^\s:]+)(?::(?P<port>\d+))?\s+)?'
+    r'\S+ \S+ \S+ \[[^\]]*\] "[^"]*" \d{3} \S+ "[^"]*" "[^"]*"'
+    r'(?: "(?P<host>[^"]*)")?'
+)
+
+# hosts whose rule is looked up once, cleared when full
+MAX_CACHED_HOSTS = 100000
+
+
+def parse_combined(match, default_scheme='http'):
+    """
+    :param match: a match of ``COMBINED_LINE``
+    :return: a ``(host, scheme)`` tuple, or None if the line has no host
+    """
+    host = match.group('host') or match.group('vhost')
+    if not host or host == '-':
+        return None
+    scheme = 'https' if match.group('port') == '443' else default_scheme
+    return host, scheme
+
+
+def parse_plain(line, default_scheme='http'):
+    """
+    Parses ``host [scheme [path]]`` lines and urls.
+    :return: a ``(host, scheme)`` tuple, or None for empty lines
+    """
+    fields = line.split()
+    if not fields:
+        return None
+    if '://' in fields[0]:
+        scheme, _, rest = fields[0].partition('://')
+        return rest.split('/', 1)[0], scheme.lower()
+    return fields[0], fields[1].lower() if len(fields) > 1 else default_scheme
+
+
+def parse_line(line, log_format=None, default_scheme='http'):
+    """
+    :param log_format: ``COMBINED``, ``PLAIN`` or None to try both
+    """
+    if log_format != PLAIN:
+        match = COMBINED_LINE.match(line)
+        if match is not None:
+            return parse_combined(match, default_scheme)
+        if log_format == COMBINED:
+            return None
+    return parse_plain(line, default_scheme)
+
+
+def open_log(path):
+    """
+    Opens a log file (``-`` for stdin) for reading lines, gzipped files are
+    decompressed on the fly.
+    """
+    if path == '-':
+        return io.open(sys.stdin.fileno(), encoding='utf-8', errors='replace', closefd=False)
+    with open(path, 'rb') as f:
+        gzipped = f.read(2) == b'\x1f\x8b'
+    if gzipped:
+        return io.TextIOWrapper(gzip.open(path, 'rb'), encoding='utf-8', errors='replace')
+    return io.open(path, encoding='utf-8', errors='replace')
+
+
+def uses_regexes(router, host):
+    """
+    :return: whether ``router`` has to check its regexes for ``host``
+    """
+    if isinstance(router, SitesRouter):
+        if host in router.hosts:
+            return False
+        site_id = router.wildcards.match(host)
+        if site_id is None:
+            return True
+        router = router.routers[site_id]
+    elif host in router.domains or host in router.redirect_domains:
+        return False
+    tier = router.match_wildcard(host)
+    if tier == ALIAS:
+        # redirect regexes win over alias wildcards
+        return bool(router.patterns.get_patterns(REDIRECT))
+    return tier is None
+
+
+class Report(object):
+    """
+    The results of replaying requests, can be merged with the results of
+    other processes.
+
+    ``rule_hits`` is keyed on ``(kind, key)`` of the rules in
+    ``aldryn_sites.export``, ``deltas`` on ``(host, scheme, current target,
+    proposed target)`` with the targets as urls or None.
+    """
+    def __init__(self):
+        self.requests = 0
+        self.skipped = 0
+        self.duration = 0.0
+        self.branches = dict.fromkeys(BRANCHES, 0)
+        self.regex_hosts = Counter()
+        self.rule_hits = Counter()
+        self.changed = 0
+        self.deltas = Counter()
+
+    def merge(self, other):
+        self.requests += other.requests
+        self.skipped += other.skipped
+        self.duration += other.duration
+        for branch, count in other.branches.items():
+            self.branches[branch] += count
+        self.regex_hosts.update(other.regex_hosts)
+        self.rule_hits.update(other.rule_hits)
+        self.changed += other.changed
+        self.deltas.update(other.deltas)
+        return self
+
+
+class Replayer(object):
+    """
+    Replays requests through ``router`` (a ``SitesRouter`` or a
+    ``SiteRouter``, like ``SiteMiddleware.router``), the same way
+    ``SiteMiddleware`` resolves them.
+
+    If ``current`` is given, ``router`` is a proposed config and the
+    requests are also resolved with ``current`` to find the redirects that
+    would change.
+    """
+    def __init__(self, router, current=None, log_format=None, default_scheme='http'):
+        self.router = router
+        self.current = current
+        self.log_format = log_format
+        self.default_scheme = default_scheme
+        self.rules = export.get_rules(router)
+        self.exact_rules = dict((rule.key, rule) for rule in self.rules if rule.kind == export.EXACT)
+        self.pattern_rules = [rule for rule in self.rules if rule.kind != export.EXACT]
+        self.host_rules = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['host_rules'] = {}
+        return state
+
+    def get_rule(self, host):
+        """
+        :return: ``(kind, key)`` of the rule ``host`` matches, or None
+        """
+        try:
+            return self.host_rules[host]
+        except KeyError:
+            pass
+        rule = self.exact_rules.get(host) or export.match(self.pattern_rules, host)
+        if len(self.host_rules) >= MAX_CACHED_HOSTS:
+            self.host_rules.clear()
+        self.host_rules[host] = rule = (rule.kind, rule.key) if rule is not None else None
+        return rule
+
+    def replay(self, lines, report=None):
+        """
+        :param lines: an iterable of log lines
+        :return: the ``Report``
+        """
+        if report is None:
+            report = Report()
+        for line in lines:
+            parsed = parse_line(line, self.log_format, self.default_scheme)
+            if parsed is None:
+                report.skipped += 1
+                continue
+            host, scheme = parsed
+            host = utils.normalize_host(utils.split_host(host)[0])
+            if not host:
+                report.skipped += 1
+                continue
+            report.requests += 1
+            if utils.is_ip_address(host):
+                report.branches[IP] += 1
+                continue
+            start = timer()
+            site_id, branch, target = self.router.resolve_site(host, scheme)
+            report.duration += timer() - start
+            report.branches[branch] += 1
+            if uses_regexes(self.router, host):
+                report.regex_hosts[host] += 1
+            rule = self.get_rule(host)
+            if rule is not None:
+                report.rule_hits[rule] += 1
+            if self.current is not None:
+                current_target = self.current.resolve_site(host, scheme)[2]
+                if current_target != target:
+                    report.changed += 1
+                    report.deltas[(
+                        host, scheme,
+                        export.format_target(current_target, host) if current_target else None,
+                        export.format_target(target, host) if target else None,
+                    )] += 1
+        return report
+
+    def get_unused_rules(self, report):
+        """
+        :return: the rules no request matched, in the order of ``rules``
+        """
+        return [rule for rule in self.rules if (rule.kind, rule.key) not in report.rule_hits]
+
+
+_worker_replayer = None
+
+
+def _init_worker(replayer):
+    global _worker_replayer
+    parallel.setup_worker()
+    _worker_replayer = replayer
+
+
+def _replay_chunk(lines):
+    return _worker_replayer.replay(lines)
+
+
+def replay_parallel(replayer, lines, processes, chunk_size=10000):
+    """
+    Replays ``lines`` in ``processes`` worker processes, see
+    ``aldryn_sites.parallel.map_chunks``.
+    :return: the merged ``Report``
+    """
+    report = Report()
+    for chunk_report in parallel.map_chunks(
+            _replay_chunk, lines, processes, chunk_size=chunk_size,
+            initializer=_init_worker, initargs=(replayer,)):
+        report.merge(chunk_report)
+    return report
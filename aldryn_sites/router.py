@@ -0,0 +1,694 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+import re
+from collections import OrderedDict
+
+try:
+    from sys import intern
+except ImportError:
+    # Python 2, where intern() only takes byte strings
+    def intern(string):
+        return string
+
+import yurl
+from django.core.exceptions import ImproperlyConfigured
+
+from . import utils
+
+
+REDIRECT = 'redirect'
+ALIAS = 'alias'
+
+# the branches a redirect decision can take
+EXACT_ALIAS = 'exact_alias'
+EXACT_REDIRECT = 'exact_redirect'
+SCHEME_REDIRECT = 'scheme_redirect'
+PATTERN_REDIRECT = 'pattern_redirect'
+PATTERN_ALIAS = 'pattern_alias'
+PATTERN_SCHEME_REDIRECT = 'pattern_scheme_redirect'
+NO_MATCH = 'no_match'
+IP = 'ip'
+BRANCHES = (
+    EXACT_ALIAS, EXACT_REDIRECT, SCHEME_REDIRECT,
+    PATTERN_REDIRECT, PATTERN_ALIAS, PATTERN_SCHEME_REDIRECT,
+    NO_MATCH, IP,
+)
+# branches that needed the pattern tier
+PATTERN_BRANCHES = frozenset((PATTERN_REDIRECT, PATTERN_ALIAS, PATTERN_SCHEME_REDIRECT, NO_MATCH))
+
+_DEFAULT_FLAGS = re.compile('').flags
+# the number of sites whose regexes SitesRouter.find_host_site_id checks at once
+HOST_REGEX_SITES = 50
+# patterns that refer to their own groups can't be renumbered into an alternation
+_GROUP_REFERENCE = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+
+
+class PatternMatcher(object):
+    """
+    Matches a host against all redirect and alias patterns of a site at once.
+
+    The patterns are joined into a single alternation with one named group
+    per tier, redirect patterns first. Python regexes try alternatives from
+    left to right, so a single ``match`` call both finds a hit and keeps the
+    "pattern redirect > pattern alias" priority. Patterns that can't be
+    combined (custom flags, named groups, backreferences) make the matcher
+    fall back to checking the patterns one by one.
+
+    Plain host names (``redirect_hosts`` and ``alias_hosts``) match hosts
+    that start with them. They are looked up in a ``HostPrefixes`` instead
+    of being compiled into the regex, which would take seconds and many
+    megabytes for tens of thousands of domains.
+
+    When pickled (see ``aldryn_sites.snapshot``), only the sources of the
+    regexes are stored. They are compiled again on the first ``match``, so
+    loading a router doesn't compile anything until the pattern tier is
+    needed.
+    """
+    def __init__(self, redirect_patterns, alias_patterns, redirect_hosts=(), alias_hosts=()):
+        self.tiers = (
+            (REDIRECT, tuple(redirect_patterns)),
+            (ALIAS, tuple(alias_patterns)),
+        )
+        self.redirect_hosts = HostPrefixes(redirect_hosts)
+        self.alias_hosts = HostPrefixes(alias_hosts)
+        self.regex = self.combine()
+        self.sources = None
+
+    def __getstate__(self):
+        if self.sources is not None:
+            # not compiled yet
+            return self.sources
+        return {
+            'tiers': tuple(
+                (tier, tuple((pattern.pattern, pattern.flags) for pattern in patterns))
+                for tier, patterns in self.tiers
+            ),
+            'regex': (self.regex.pattern, self.regex.flags) if self.regex is not None else None,
+            'hosts': (self.redirect_hosts, self.alias_hosts),
+        }
+
+    def __setstate__(self, state):
+        self.tiers = None
+        self.regex = None
+        self.redirect_hosts, self.alias_hosts = state['hosts']
+        self.sources = state
+
+    def compile(self):
+        if self.sources is None:
+            return
+        self.tiers = tuple(
+            (tier, tuple(re.compile(pattern, flags) for pattern, flags in patterns))
+            for tier, patterns in self.sources['tiers']
+        )
+        if self.sources['regex'] is not None:
+            self.regex = re.compile(*self.sources['regex'])
+        self.sources = None
+
+    def get_patterns(self, tier):
+        self.compile()
+        return dict(self.tiers)[tier]
+
+    def combine(self):
+        groups = []
+        for tier, patterns in self.tiers:
+            if not patterns:
+                continue
+            if not all(is_combinable(pattern) for pattern in patterns):
+                return None
+            groups.append('(?P<{}>{})'.format(
+                tier,
+                '|'.join('(?:{})'.format(pattern.pattern) for pattern in patterns),
+            ))
+        if not groups:
+            return None
+        try:
+            return re.compile('|'.join(groups))
+        except (re.error, TypeError):
+            return None
+
+    def match(self, host):
+        """
+        :return: ``REDIRECT``, ``ALIAS`` or None
+        """
+        if self.redirect_hosts.match(host):
+            return REDIRECT
+        tier = self.match_regexes(host)
+        if tier is None and self.alias_hosts.match(host):
+            return ALIAS
+        return tier
+
+    def match_redirects(self, host):
+        """
+        :return: ``REDIRECT`` if a redirect host name or regex matches, or None
+        """
+        if self.redirect_hosts.match(host) or self.match_regexes(host) == REDIRECT:
+            return REDIRECT
+        return None
+
+    def match_regexes(self, host):
+        if self.sources is not None:
+            self.compile()
+        if self.regex is not None:
+            match = self.regex.match(host)
+            return match.lastgroup if match else None
+        for tier, patterns in self.tiers:
+            if utils.match_any(patterns, host):
+                return tier
+        return None
+
+
+def is_combinable(pattern):
+    """
+    :return: whether ``pattern`` can be joined into an alternation with
+             other patterns
+    """
+    if pattern.flags != _DEFAULT_FLAGS or pattern.groupindex:
+        return False
+    return not (pattern.groups and _GROUP_REFERENCE.search(pattern.pattern))
+
+
+def anchor(pattern):
+    """
+    :return: ``pattern`` compiled to only match whole strings, like
+             ``fullmatch`` (which Python 2 doesn't have)
+    """
+    # a comment at the end of a verbose pattern would swallow the anchor
+    end = '\n' if pattern.flags & re.VERBOSE else ''
+    return re.compile('(?:{}{})\\Z'.format(pattern.pattern, end), pattern.flags)
+
+
+class HostPrefixes(object):
+    """
+    Host names that match hosts starting with them (``example.com`` matches
+    ``example.com.other.org``), like a regex without ``$``.
+
+    The names are kept in a set and looked up with a slice of the host per
+    distinct length of a name, which is a handful of set lookups no matter
+    how many names there are. ``hosts`` can be a set of the exact tier:
+    regexes in it never equal a slice of a host, as they contain characters
+    a host can't have.
+    """
+    def __init__(self, hosts):
+        # sets and dicts are shared, not copied
+        self.hosts = hosts if isinstance(hosts, (frozenset, dict)) else frozenset(hosts)
+        self.lengths = tuple(sorted(set(
+            len(host) for host in self.hosts
+            # pre-compiled regexes
+            if not hasattr(host, 'match')
+        )))
+
+    def __len__(self):
+        return len(self.hosts)
+
+    def match(self, host):
+        hosts = self.hosts
+        for length in self.lengths:
+            if length > len(host):
+                break
+            if host[:length] in hosts:
+                return True
+        return False
+
+
+def is_plain_host(entry):
+    """
+    :return: whether ``entry`` is a host name and not a regex
+    """
+    if hasattr(entry, 'match'):
+        return False
+    return re.escape(entry).replace('\\-', '-').replace('\\.', '.') == entry
+
+
+def get_wildcard_suffix(entry):
+    """
+    :return: the suffix of a ``*.example.com`` wildcard (``''`` for ``*``),
+             or None if ``entry`` isn't a wildcard
+    """
+    if hasattr(entry, 'match'):
+        # a pre-compiled regex
+        return None
+    if entry == '*':
+        return ''
+    if entry.startswith('*.') and entry[2:] and '*' not in entry[2:]:
+        return entry[2:]
+    return None
+
+
+def normalize_entry(entry):
+    """
+    Normalizes host names and wildcards with ``utils.normalize_host``,
+    regexes are kept as they are. Host names are interned, so routers
+    built from the same config (e.g. on a reload) share them.
+    """
+    suffix = get_wildcard_suffix(entry)
+    if suffix:
+        return intern('*.{}'.format(utils.get_normalized_host(suffix)))
+    if suffix is None and is_plain_host(entry):
+        return intern(utils.get_normalized_host(entry))
+    return entry
+
+
+class WildcardTrie(object):
+    """
+    Wildcard domains (``*.example.com``) in a trie keyed on reversed labels.
+
+    A wildcard matches any host with at least one more label than its
+    suffix, ``*`` matches every host. Looking up a host walks down one
+    label at a time and returns the value of the most specific wildcard, so
+    the cost depends on the number of labels in the host and not on the
+    number of wildcards.
+    """
+    def __init__(self):
+        self.root = {}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, suffix, value):
+        node = self.root
+        if suffix:
+            for label in reversed(suffix.split('.')):
+                # most labels (``com``, ``example``) are in many suffixes
+                node = node.setdefault(intern(label), {})
+        if None not in node:
+            self.size += 1
+        # None can't clash with a label
+        node[None] = value
+
+    def get(self, suffix):
+        """
+        :return: the value of the wildcard for ``suffix`` itself, or None
+        """
+        node = self.root
+        if suffix:
+            for label in reversed(suffix.split('.')):
+                node = node.get(label)
+                if node is None:
+                    return None
+        return node.get(None)
+
+    def match(self, host):
+        labels = host.split('.')
+        node = self.root
+        value = node.get(None)
+        # stop before the first label: a wildcard needs at least one label
+        for index in range(len(labels) - 1, 0, -1):
+            node = node.get(labels[index])
+            if node is None:
+                break
+            value = node.get(None, value)
+        return value
+
+
+class SiteRouter(object):
+    """
+    Compiled redirect rules for a single entry of ``ALDRYN_SITES_DOMAINS``.
+
+    All sets and regexes are built once in ``__init__``, so ``resolve`` only
+    does hash lookups followed by the (already ordered) pattern checks.
+    priorities are (primary domain and aliases are treated the same):
+        exact redirect match > exact alias match > pattern redirect match > pattern alias match
+    Patterns are wildcards (``*.example.com``) and regexes. Redirect
+    wildcards are checked first, then redirect regexes, alias wildcards and
+    alias regexes, so a wildcard behaves like the equivalent regex.
+
+    Redirects go to ``redirect_domain``, which is the primary domain unless
+    ``SitesRouter`` moved the site to the domain of another site (see
+    ``move_to``).
+    """
+    def __init__(self, config, https=None, site_id=None):
+        self.domain = normalize_entry(config['domain'])
+        self.redirect_domain = self.domain
+        self.https = https
+        self.site_id = site_id
+        self.redirect_wildcards = WildcardTrie()
+        self.alias_wildcards = WildcardTrie()
+        self.wildcard_suffixes = set()
+        aliases = [self.domain] + [normalize_entry(entry) for entry in config.get('aliases', [])]
+        aliases = self.add_wildcards(aliases, self.alias_wildcards)
+        redirects = self.add_wildcards(
+            [normalize_entry(entry) for entry in config.get('redirects', [])], self.redirect_wildcards)
+        self.domains = frozenset(aliases)
+        self.redirect_domains = frozenset(redirects)
+        # keep the configured order, so the pattern tier is deterministic
+        self.patterns = PatternMatcher(
+            utils.compile_regexes(entry for entry in redirects if not is_plain_host(entry)),
+            utils.compile_regexes(entry for entry in aliases if not is_plain_host(entry)),
+            # shares the sets of the exact tier
+            redirect_hosts=self.redirect_domains,
+            alias_hosts=self.domains,
+        )
+
+    @property
+    def domain_patterns(self):
+        return self.patterns.get_patterns(ALIAS)
+
+    @property
+    def redirect_domain_patterns(self):
+        return self.patterns.get_patterns(REDIRECT)
+
+    def move_to(self, domain):
+        """
+        Redirects the primary domain as well as all redirects to ``domain``.
+        """
+        self.redirect_domain = domain
+        self.domains = self.domains - {self.domain}
+        self.redirect_domains = self.redirect_domains | {self.domain}
+
+    def add_wildcards(self, entries, trie):
+        """
+        Adds the wildcards in ``entries`` to ``trie``.
+        :return: the other entries
+        """
+        rest = []
+        for entry in entries:
+            suffix = get_wildcard_suffix(entry)
+            if suffix is None:
+                rest.append(entry)
+            else:
+                trie.add(suffix, True)
+                self.wildcard_suffixes.add(suffix)
+        return rest
+
+    def get_wildcard_tier(self, suffix):
+        """
+        :return: the tier of the wildcard for ``suffix``, a redirect wins over
+                 an alias with the same suffix
+        """
+        if self.redirect_wildcards.get(suffix):
+            return REDIRECT
+        if self.alias_wildcards.get(suffix):
+            return ALIAS
+        return None
+
+    def match_wildcard(self, host):
+        """
+        :return: ``REDIRECT``, ``ALIAS`` or None
+        """
+        if self.redirect_wildcards and self.redirect_wildcards.match(host):
+            return REDIRECT
+        if self.alias_wildcards and self.alias_wildcards.match(host):
+            return ALIAS
+        return None
+
+    def match_pattern(self, host):
+        """
+        :return: ``REDIRECT``, ``ALIAS`` or None
+        """
+        tier = self.match_wildcard(host)
+        if tier == ALIAS:
+            # a redirect regex still wins over an alias wildcard
+            return self.patterns.match_redirects(host) or ALIAS
+        if tier is not None:
+            return tier
+        return self.patterns.match(host)
+
+    def get_target_scheme(self, scheme):
+        if self.https is None:
+            return scheme
+        return 'https' if self.https else 'http'
+
+    def get_decision(self, host, scheme):
+        """
+        :param host: the host that is being called
+        :param scheme: the scheme that is being called
+        :return: a ``(branch, target)`` tuple, target being None for no
+                 redirect or the ``(scheme, host)`` to redirect to
+        """
+        target_scheme = self.get_target_scheme(scheme)
+        if host in self.domains:
+            if scheme == target_scheme:
+                # exact host and scheme match: Nothing to do
+                return EXACT_ALIAS, None
+            # exact alias match, but scheme mismatch: redirect to changed scheme
+            return SCHEME_REDIRECT, (target_scheme, host)
+        if host in self.redirect_domains:
+            # exact redirect match: redirect
+            return EXACT_REDIRECT, (target_scheme, self.redirect_domain)
+        return self.get_pattern_decision(self.match_pattern(host), host, scheme)
+
+    def get_pattern_decision(self, tier, host, scheme):
+        """
+        :param tier: the tier of the pattern ``host`` matched, None for no match
+        :return: a ``(branch, target)`` tuple, see ``get_decision``
+        """
+        target_scheme = self.get_target_scheme(scheme)
+        if tier == REDIRECT:
+            # pattern redirect match: redirect
+            return PATTERN_REDIRECT, (target_scheme, self.redirect_domain)
+        if tier == ALIAS:
+            if scheme != target_scheme:
+                # pattern alias match and scheme mismatch: redirect
+                return PATTERN_SCHEME_REDIRECT, (target_scheme, host)
+            return PATTERN_ALIAS, None
+        return NO_MATCH, None
+
+    def resolve(self, host, scheme):
+        """
+        :return: None for no redirect or a ``(scheme, host)`` tuple to redirect to
+        """
+        return self.get_decision(host, scheme)[1]
+
+    def resolve_site(self, host, scheme):
+        """
+        :return: a ``(site_id, branch, target)`` tuple, see ``get_decision``
+        """
+        branch, target = self.get_decision(host, scheme)
+        return self.site_id, branch, target
+
+    def get_redirect_url(self, current_url):
+        """
+        :param current_url: the url that is being called
+        :return: None for no redirect or an url to redirect to
+        """
+        url = yurl.URL(current_url)
+        if url.is_host_ip() or url.is_host_ipv4():
+            # don't redirect for ips
+            return None
+        target = self.resolve(utils.normalize_host(url.host), url.scheme)
+        if target is None:
+            return None
+        scheme, host = target
+        port = utils.normalize_port(url.port, url.scheme)
+        return '{}'.format(url.replace(scheme=scheme, host=host, port=port))
+
+
+def combine_sites(sites):
+    """
+    :param sites: a list of ``(site_id, patterns)`` tuples, with patterns
+                  that are combinable (see ``is_combinable``)
+    :return: a list of ``(regex, site_id, groups)`` tuples, see
+             ``SitesRouter.get_host_regexes``
+    """
+    if sites:
+        groups = dict(('s{}'.format(index), site_id) for index, (site_id, patterns) in enumerate(sites))
+        try:
+            regex = re.compile('(?:{})\\Z'.format('|'.join(
+                '(?P<s{}>{})'.format(index, '|'.join('(?:{})'.format(pattern.pattern) for pattern in patterns))
+                for index, (site_id, patterns) in enumerate(sites)
+            )))
+        except (re.error, TypeError, AssertionError):
+            # e.g. more than 100 groups on Python 2
+            pass
+        else:
+            return [(regex, None, groups)]
+    return [(anchor(pattern), site_id, None) for site_id, patterns in sites for pattern in patterns]
+
+
+class SitesRouter(object):
+    """
+    Compiled redirect rules for all sites in ``ALDRYN_SITES_DOMAINS``.
+
+    Every domain, alias and redirect is indexed by host, so the site serving
+    an exact host is found with a single dict lookup. A host that is a
+    domain or alias of one site and a redirect of another belongs to the
+    former. Wildcards of all sites share one trie, the most specific wildcard
+    wins. Other hosts are matched against the regexes of each site in order
+    of site id and fall back to ``default_site_id``.
+
+    If the primary domain of a site is a redirect of another site, the site
+    has moved: its domain and redirects are redirected as well, and all
+    redirects go straight to the domain at the end of the chain, so clients
+    only follow one redirect. A chain that leads back to a site raises
+    ``ImproperlyConfigured``.
+    """
+    def __init__(self, domains, https=None, default_site_id=None):
+        # only kept to tell whether this router was built from ``domains``
+        self.config = domains
+        self.https = https
+        self.default_site_id = default_site_id
+        self.routers = OrderedDict(
+            (site_id, SiteRouter(domains[site_id], https=https, site_id=site_id))
+            for site_id in sorted(domains.keys())
+        )
+        alias_hosts, redirect_hosts = self.index_hosts()
+        moved = dict(
+            (site_id, redirect_hosts[router.domain])
+            for site_id, router in self.routers.items()
+            if alias_hosts[router.domain] == site_id and redirect_hosts.get(router.domain, site_id) != site_id
+        )
+        if moved:
+            self.collapse_redirects(moved)
+            alias_hosts, redirect_hosts = self.index_hosts()
+            for site_id, target_site_id in moved.items():
+                # the site that redirects the domain, not the one it belonged to
+                redirect_hosts[self.routers[site_id].domain] = target_site_id
+        self.hosts = redirect_hosts
+        self.hosts.update(alias_hosts)
+        # the host names of all sites, to skip them for hosts that match none
+        self.host_prefixes = HostPrefixes(self.hosts)
+        self.host_regexes = None
+        self.wildcards = WildcardTrie()
+        # added in reverse, so the lowest site id wins for the same suffix
+        for site_id, router in reversed(list(self.routers.items())):
+            for suffix in router.wildcard_suffixes:
+                self.wildcards.add(suffix, site_id)
+
+    def index_hosts(self):
+        """
+        :return: two dicts of host to the lowest id of a site that has it as
+                 a domain or alias and as a redirect
+        """
+        alias_hosts = {}
+        redirect_hosts = {}
+        for site_id, router in self.routers.items():
+            for host in router.domains:
+                alias_hosts.setdefault(host, site_id)
+            for host in router.redirect_domains:
+                redirect_hosts.setdefault(host, site_id)
+        return alias_hosts, redirect_hosts
+
+    def collapse_redirects(self, moved):
+        """
+        Moves every site in ``moved`` to the domain at the end of its chain.
+        :param moved: a dict of the id of a site whose domain is a redirect
+                      of another site to the id of that site
+        :raises ImproperlyConfigured: if a chain leads back to a site
+        """
+        for site_id in sorted(moved):
+            chain = [site_id]
+            target_site_id = moved[site_id]
+            while target_site_id in moved:
+                if target_site_id in chain:
+                    chain = chain[chain.index(target_site_id):] + [target_site_id]
+                    raise ImproperlyConfigured('ALDRYN_SITES_DOMAINS has a redirect cycle: {}.'.format(
+                        ' -> '.join('{} (site {})'.format(
+                            self.routers[chain_site_id].domain, chain_site_id) for chain_site_id in chain)))
+                chain.append(target_site_id)
+                target_site_id = moved[target_site_id]
+            self.routers[site_id].move_to(self.routers[target_site_id].domain)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # a snapshot is checked against the config by its hash instead
+        state['config'] = None
+        # built again when needed
+        state['host_regexes'] = None
+        return state
+
+    def compile(self):
+        """
+        Compiles the regexes of all sites, e.g. before forking workers so
+        they share the compiled regexes.
+        """
+        for router in self.routers.values():
+            router.patterns.compile()
+
+    def is_built_from(self, domains, https=None, default_site_id=None):
+        return (
+            self.config is domains and
+            self.https == https and
+            self.default_site_id == default_site_id
+        )
+
+    def find_site_id(self, host):
+        """
+        :return: the id of the site ``host`` belongs to, or None
+        """
+        site_id = self.hosts.get(host)
+        if site_id is not None:
+            return site_id
+        if self.wildcards:
+            site_id = self.wildcards.match(host)
+            if site_id is not None:
+                return site_id
+        if self.host_prefixes.match(host):
+            for site_id, router in self.routers.items():
+                if router.patterns.match(host):
+                    return site_id
+        else:
+            for site_id, router in self.routers.items():
+                if router.patterns.match_regexes(host):
+                    return site_id
+        return None
+
+    def find_host_site_id(self, host):
+        """
+        Like ``find_site_id``, but host names only match equal hosts and
+        regexes have to match all of ``host``, e.g. to validate hosts.
+        :param host: a host that passed Django's syntax check
+        :return: the id of the site ``host`` belongs to, or None
+        """
+        site_id = self.hosts.get(host)
+        # regexes are in ``hosts`` as well
+        if site_id is not None and is_plain_host(host):
+            return site_id
+        if self.wildcards:
+            site_id = self.wildcards.match(host)
+            if site_id is not None:
+                return site_id
+        for regex, site_id, groups in self.get_host_regexes():
+            match = regex.match(host)
+            if match:
+                return groups[match.lastgroup] if groups else site_id
+        return None
+
+    def get_host_regexes(self):
+        """
+        The regexes of all sites, anchored at the end for
+        ``find_host_site_id``. The regexes of up to ``HOST_REGEX_SITES``
+        sites are joined into one alternation with a named group per site,
+        so a host that matches none (e.g. a flood of random hosts) doesn't
+        cost a regex per site.
+        :return: a list of ``(regex, site_id, groups)`` tuples, ``groups``
+                 being None or a dict of group name to site id
+        """
+        if self.host_regexes is not None:
+            return self.host_regexes
+        host_regexes = []
+        chunk = []
+        for site_id, router in self.routers.items():
+            patterns = router.patterns.get_patterns(REDIRECT) + router.patterns.get_patterns(ALIAS)
+            if all(is_combinable(pattern) for pattern in patterns):
+                if patterns:
+                    chunk.append((site_id, patterns))
+                if len(chunk) < HOST_REGEX_SITES:
+                    continue
+                host_regexes.extend(combine_sites(chunk))
+            else:
+                # keeps the order of the sites
+                host_regexes.extend(combine_sites(chunk))
+                host_regexes.extend((anchor(pattern), site_id, None) for pattern in patterns)
+            chunk = []
+        host_regexes.extend(combine_sites(chunk))
+        self.host_regexes = host_regexes
+        return host_regexes
+
+    def get_site_id(self, host):
+        site_id = self.find_site_id(host)
+        if site_id is None:
+            return self.default_site_id
+        return site_id
+
+    def resolve_site(self, host, scheme):
+        """
+        :return: a ``(site_id, branch, target)`` tuple, see
+                 ``SiteRouter.get_decision``
+        """
+        site_id = self.get_site_id(host)
+        router = self.routers.get(site_id)
+        if router is None:
+            return site_id, NO_MATCH, None
+        branch, target = router.get_decision(host, scheme)
+        return site_id, branch, target
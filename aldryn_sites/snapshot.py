@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+import hashlib
+import json
+import logging
+import os
+import pickle
+import tempfile
+
+from . import __version__
+from .router import SitesRouter
+
+
+logger = logging.getLogger(__name__)
+
+# bump when the pickled router classes change incompatibly
+SNAPSHOT_FORMAT = 5
+
+
+def _json_default(value):
+    if hasattr(value, 'match'):
+        # a pre-compiled regex
+        return {'pattern': value.pattern, 'flags': value.flags}
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    raise TypeError('{!r} is not JSON serializable'.format(value))
+
+
+def get_config_hash(domains, https=None, default_site_id=None):
+    """
+    :return: a hash of everything a ``SitesRouter`` is built from, including
+             the version of aldryn-sites and the snapshot format
+    """
+    content = json.dumps(
+        [SNAPSHOT_FORMAT, __version__, https, default_site_id, sorted(
+            ('{}'.format(site_id), site_config) for site_id, site_config in domains.items()
+        )],
+        sort_keys=True,
+        default=_json_default,
+    )
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def save_snapshot(router, path, config_hash=None):
+    """
+    Writes ``router`` to ``path``, replacing an existing snapshot atomically.
+    """
+    if config_hash is None:
+        config_hash = get_config_hash(router.config, router.https, router.default_site_id)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.aldryn-sites-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            # the hash comes first, so a stale snapshot is detected without
+            # loading the router
+            pickle.dump(config_hash, f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(router, f, pickle.HIGHEST_PROTOCOL)
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def load_snapshot(path, domains, https=None, default_site_id=None, config_hash=None):
+    """
+    :return: the ``SitesRouter`` stored in ``path``, or None if there is no
+             snapshot or it was built from a different config
+    """
+    if config_hash is None:
+        config_hash = get_config_hash(domains, https, default_site_id)
+    try:
+        with open(path, 'rb') as f:
+            if pickle.load(f) != config_hash:
+                return None
+            router = pickle.load(f)
+    except (IOError, OSError, EOFError, pickle.UnpicklingError):
+        return None
+    router.config = domains
+    return router
+
+
+def get_router(path, domains, https=None, default_site_id=None):
+    """
+    Loads the router for ``domains`` from the snapshot at ``path``. If the
+    snapshot is missing or stale, builds the router and writes a new one.
+    """
+    config_hash = get_config_hash(domains, https, default_site_id)
+    router = load_snapshot(path, domains, https, default_site_id, config_hash=config_hash)
+    if router is not None:
+        return router
+    router = SitesRouter(domains, https=https, default_site_id=default_site_id)
+    try:
+        save_snapshot(router, path, config_hash=config_hash)
+    except (IOError, OSError) as e:
+        logger.warning('Could not write the router snapshot %s: %s', path, e)
+    return router
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+import bisect
+from collections import Counter
+
+from .router import BRANCHES, PATTERN_BRANCHES
+
+
+# upper bounds of the latency histogram buckets, in microseconds
+LATENCY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+
+class Stats(object):
+    """
+    Per-process counters of the redirect decisions taken by ``SiteMiddleware``.
+
+    Counts decisions per branch (see ``aldryn_sites.router.BRANCHES``), keeps
+    a histogram of decision latencies and counts the hosts that needed the
+    pattern tier. There is no locking: under heavy thread contention a few
+    increments may get lost, which is fine for metrics.
+
+    ``hook`` is called with ``(branch, host, duration)`` after every
+    decision, to push the data to a metrics system.
+    """
+    def __init__(self, hook=None, max_pattern_hosts=1000):
+        self.hook = hook
+        self.max_pattern_hosts = max_pattern_hosts
+        self.reset()
+
+    def reset(self):
+        self.branches = dict.fromkeys(BRANCHES, 0)
+        # one more bucket for everything above the last bound
+        self.latency = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.pattern_hosts = Counter()
+
+    def record(self, branch, host, duration):
+        """
+        :param duration: in seconds
+        """
+        self.branches[branch] += 1
+        self.latency[bisect.bisect_left(LATENCY_BUCKETS, duration * 1e6)] += 1
+        if branch in PATTERN_BRANCHES:
+            if host in self.pattern_hosts or len(self.pattern_hosts) < self.max_pattern_hosts:
+                self.pattern_hosts[host] += 1
+        if self.hook is not None:
+            self.hook(branch, host, duration)
+
+    def top_pattern_hosts(self, n=10):
+        return self.pattern_hosts.most_common(n)
+
+    def snapshot(self):
+        return {
+            'branches': dict(self.branches),
+            'latency': [
+                (bound, count)
+                for bound, count in zip(LATENCY_BUCKETS + (None,), self.latency)
+            ],
+            'top_pattern_hosts': self.top_pattern_hosts(),
+        }
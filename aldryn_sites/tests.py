@@ -1,17 +1,44 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals, absolute_import
 
+import gzip
+import json
+import os
 import re
+import shutil
+import signal
+import tempfile
+import threading
+from collections import Counter
 
 from unittest import skipIf
 
 import yurl
 
 from django import VERSION as DJANGO_VERSION
+from django.apps import apps as django_apps
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command, CommandError
 from django.test import TestCase, RequestFactory
 from django.contrib.sites.models import Site
 
-from . import utils, middleware
+try:
+    from django.utils.six import StringIO
+except ImportError:
+    from io import StringIO
+
+from . import apps, canonical, conf, export, hosts, loader, paths, replay, snapshot, utils, middleware
+from .models import SiteDomain
+from .router import SiteRouter, SitesRouter, PatternMatcher, HostPrefixes, WildcardTrie, REDIRECT, ALIAS
+
+
+recorded_decisions = []
+
+
+def record_decision(branch, host, duration):
+    recorded_decisions.append((branch, host))
 
 
 class RedirectOnlyTestingSiteMiddleware(middleware.SiteMiddleware):
@@ -19,6 +46,7 @@ class RedirectOnlyTestingSiteMiddleware(middleware.SiteMiddleware):
         self.site_id = site_id
         self.domains = domains
         self.secure_redirect = secure_redirect
+        self.set_router(self.get_sites_router())
 
 
 class AldrynSitesTestCase(TestCase):
@@ -257,10 +285,607 @@ class AldrynSitesTestCase(TestCase):
                 msg='expected {} -> {}. got {}'.format(src, expected, redirected),
             )
 
+    def test_get_redirect_url_cached(self):
+        config = {'domain': 'www.default.com', 'redirects': ['default.com']}
+        router = utils.get_config_router(config, https=True)
+        self.assertIs(utils.get_config_router(config, https=True), router)
+        self.assertIsNot(utils.get_config_router(config, https=False), router)
+        self.assertIsNot(utils.get_config_router(dict(config), https=True), router)
+        self.assertIsNone(utils.get_redirect_url('https://old.default.com/', config, https=True))
+        # a changed config is compiled again
+        config['redirects'].append('old.default.com')
+        self.assertEqual(
+            utils.get_redirect_url('https://old.default.com/', config, https=True), 'https://www.default.com/')
+        # pre-compiled regexes are shared with the copy, not copied
+        config['aliases'] = [re.compile(r'^[a-z]+\.default\.me$')]
+        router = utils.get_config_router(config, https=True)
+        self.assertIs(utils.get_config_router(config, https=True), router)
+        self.assertIs(utils.copy_config(config)['aliases'][0], config['aliases'][0])
+
+    def test_router_resolve(self):
+        router = SiteRouter({
+            'domain': 'www.default.com',
+            'aliases': ['an.other.domain.com', r'^[a-z0-9-]+\.default\.me$'],
+            'redirects': ['default.com', r'^[a-z0-9-]+\.default\.io$'],
+        }, https=True)
+        self.assertIsNone(router.resolve('www.default.com', 'https'))
+        self.assertEqual(router.resolve('www.default.com', 'http'), ('https', 'www.default.com'))
+        self.assertEqual(router.resolve('default.com', 'https'), ('https', 'www.default.com'))
+        self.assertEqual(router.resolve('foo.default.io', 'http'), ('https', 'www.default.com'))
+        self.assertEqual(router.resolve('foo.default.me', 'http'), ('https', 'foo.default.me'))
+        self.assertIsNone(router.resolve('foo.default.me', 'https'))
+        self.assertIsNone(router.resolve('unknown.com', 'http'))
+
+    def test_pattern_matcher(self):
+        redirect_patterns = utils.compile_regexes([r'^[a-z]+\.default\.com$', r'^.*\.default\.io$'])
+        alias_patterns = utils.compile_regexes([r'^[a-z0-9]+\.default\.com$'])
+        matcher = PatternMatcher(redirect_patterns, alias_patterns)
+        self.assertIsNotNone(matcher.regex)
+        self.assertEqual(matcher.match('abc.default.com'), REDIRECT)
+        self.assertEqual(matcher.match('a.b.default.io'), REDIRECT)
+        self.assertEqual(matcher.match('abc1.default.com'), ALIAS)
+        self.assertIsNone(matcher.match('abc.default.me'))
+
+        # patterns with flags can't be combined, but are still checked in order
+        alias_patterns.append(re.compile(r'^[a-z]+\.DEFAULT\.me$', re.IGNORECASE))
+        matcher = PatternMatcher(redirect_patterns, alias_patterns)
+        self.assertIsNone(matcher.regex)
+        self.assertEqual(matcher.match('abc.default.com'), REDIRECT)
+        self.assertEqual(matcher.match('abc.default.me'), ALIAS)
+        self.assertIsNone(matcher.match('unknown.com'))
+
+        # host names match as prefixes, redirects before regex aliases
+        matcher = PatternMatcher([], alias_patterns, redirect_hosts=['www.default.me', 'default.org'])
+        self.assertEqual(matcher.match('www.default.me'), REDIRECT)
+        self.assertEqual(matcher.match('default.org.other.com'), REDIRECT)
+        # dots only match dots
+        self.assertIsNone(matcher.match('wwwxdefault.me'))
+        self.assertIsNone(matcher.match('default-org.com'))
+        self.assertEqual(HostPrefixes(frozenset(['a.com', 'b.com', re.compile('^c')])).lengths, (5,))
+
+    def test_wildcard_trie(self):
+        trie = WildcardTrie()
+        trie.add('example.com', 'a')
+        trie.add('deep.example.com', 'b')
+        self.assertEqual(len(trie), 2)
+        self.assertEqual(trie.match('www.example.com'), 'a')
+        self.assertEqual(trie.match('a.b.example.com'), 'a')
+        self.assertEqual(trie.match('x.deep.example.com'), 'b')
+        self.assertEqual(trie.match('deep.example.com'), 'a')
+        self.assertIsNone(trie.match('example.com'))
+        self.assertIsNone(trie.match('www.example.org'))
+        trie.add('', 'c')
+        self.assertEqual(trie.match('www.example.org'), 'c')
+        self.assertEqual(trie.match('localhost'), 'c')
+
+    def test_router_wildcards(self):
+        router = SiteRouter({
+            'domain': 'www.default.com',
+            'aliases': ['*.default.com', '*.default.me'],
+            'redirects': ['*.default.me', '*.old.default.com', r'^[a-z]+\.default\.io$', r'^old\.default\.com$'],
+        }, https=True)
+        self.assertIsNone(router.resolve('www.default.com', 'https'))
+        self.assertIsNone(router.resolve('foo.default.com', 'https'))
+        self.assertEqual(router.resolve('foo.default.com', 'http'), ('https', 'foo.default.com'))
+        # redirect wildcards and regexes win over alias wildcards, like regexes would
+        self.assertEqual(router.resolve('foo.old.default.com', 'https'), ('https', 'www.default.com'))
+        self.assertEqual(router.resolve('old.default.com', 'https'), ('https', 'www.default.com'))
+        self.assertEqual(router.resolve('foo.default.me', 'https'), ('https', 'www.default.com'))
+        self.assertEqual(router.resolve('foo.default.io', 'https'), ('https', 'www.default.com'))
+        self.assertIsNone(router.resolve('unknown.com', 'https'))
+        # ``*`` matches any other host
+        router = SiteRouter({'domain': 'www.default.com', 'aliases': ['*.default.com'], 'redirects': ['*']})
+        self.assertEqual(router.resolve('unknown.com', 'https'), ('https', 'www.default.com'))
+        self.assertEqual(router.resolve('foo.default.com', 'https'), ('https', 'www.default.com'))
+        self.assertIsNone(router.resolve('www.default.com', 'https'))
+
+        sites_router = SitesRouter({
+            1: {'domain': 'www.site1.com', 'aliases': ['*.site1.com']},
+            2: {'domain': 'www.site2.com', 'redirects': ['*.site1.com', '*.site2.com']},
+        })
+        self.assertEqual(sites_router.get_site_id('foo.site1.com'), 1)
+        self.assertEqual(sites_router.get_site_id('foo.site2.com'), 2)
+        self.assertIsNone(sites_router.get_site_id('unknown.com'))
+
+    def test_request_host_parsing(self):
+        self.assertEqual(utils.split_host('www.default.com'), ('www.default.com', ''))
+        self.assertEqual(utils.split_host('www.default.com:8000'), ('www.default.com', '8000'))
+        self.assertEqual(utils.split_host('[::1]'), ('[::1]', ''))
+        self.assertEqual(utils.split_host('[::1]:8000'), ('[::1]', '8000'))
+        self.assertTrue(utils.is_ip_address('127.0.0.1'))
+        self.assertTrue(utils.is_ip_address('[::1]'))
+        self.assertTrue(utils.is_ip_address('[2001:db8::1]'))
+        self.assertFalse(utils.is_ip_address('www.default.com'))
+        self.assertFalse(utils.is_ip_address('1.2.3.default.com'))
+
+    def test_middleware_ports_and_ips(self):
+        config = {
+            'domain': 'www.default.com',
+            'redirects': ['default.com', '*'],
+        }
+        with self.settings(
+            ALDRYN_SITES_DOMAINS={1: config},
+            SECURE_SSL_REDIRECT=None,
+        ):
+            site_middleware = middleware.SiteMiddleware()
+
+        request = self.factory.get('/a/?b=c', HTTP_HOST='default.com:8000')
+        response = site_middleware.process_request(request)
+        self.assertEqual(response['Location'], 'http://www.default.com:8000/a/?b=c')
+        for host in ['127.0.0.1', '127.0.0.1:8000', '[::1]', '[::1]:8000']:
+            request = self.factory.get('/', HTTP_HOST=host)
+            self.assertIsNone(site_middleware.process_request(request))
+
+    def test_host_normalization(self):
+        self.assertEqual(utils.normalize_host('WWW.Default.COM.'), 'www.default.com')
+        self.assertEqual(utils.normalize_host('Bücher.example'), 'xn--bcher-kva.example')
+        self.assertEqual(utils.normalize_host('[::1]'), '[::1]')
+        self.assertEqual(utils.normalize_port('80', 'http'), '')
+        self.assertEqual(utils.normalize_port('443', 'http'), '443')
+        self.assertEqual(utils.normalize_port('8000', 'https'), '8000')
+
+        config = {
+            'domain': 'WWW.Default.com',
+            'aliases': ['bücher.example', '*.Customers.com'],
+            'redirects': ['Default.com.'],
+        }
+        router = SiteRouter(config, https=True)
+        self.assertEqual(router.domain, 'www.default.com')
+        self.assertEqual(router.get_decision('xn--bcher-kva.example', 'https'), ('exact_alias', None))
+        self.assertEqual(router.get_decision('a.customers.com', 'https'), ('pattern_alias', None))
+        self.assertEqual(router.get_redirect_url('http://DEFAULT.com./a/'), 'https://www.default.com/a/')
+        # default ports are dropped like in SiteMiddleware, others are kept
+        self.assertEqual(router.get_redirect_url('http://default.com:80/a/?b#c'), 'https://www.default.com/a/?b#c')
+        self.assertEqual(
+            utils.get_redirect_url('http://a.com:80/x', {'domain': 'www.a.com', 'redirects': ['a.com']}, https=True),
+            'https://www.a.com/x',
+        )
+        self.assertEqual(router.get_redirect_url('http://default.com:8000/a/'), 'https://www.default.com:8000/a/')
+
+        with self.settings(ALDRYN_SITES_DOMAINS={1: config}, SECURE_SSL_REDIRECT=True):
+            site_middleware = middleware.SiteMiddleware()
+        request = self.factory.get('/a/', HTTP_HOST='Default.COM.:80')
+        self.assertEqual(site_middleware.process_request(request)['Location'], 'https://www.default.com/a/')
+        request = self.factory.get('/a/', HTTP_HOST='WWW.DEFAULT.COM', secure=True)
+        self.assertIsNone(site_middleware.process_request(request))
+
+    def test_path_redirects(self):
+        path_redirects = paths.PathRedirects([
+            ('/old/', '/new/'),
+            ('/caf%C3%A9/', '/coffee/'),
+            ('/blog/*', '/news/*'),
+            ('/blog/2019/*', '/archive/'),
+            ('/b*', '/b/'),
+            ('/old/', '/newer/'),
+        ])
+        self.assertEqual(len(path_redirects), 5)
+        self.assertEqual(path_redirects.get('/old/'), '/newer/')
+        self.assertEqual(path_redirects.get('/café/'), '/coffee/')
+        self.assertEqual(path_redirects.get('/blog/a/b/'), '/news/a/b/')
+        self.assertEqual(path_redirects.get('/blog/2019/a/'), '/archive/')
+        self.assertEqual(path_redirects.get('/blog/2018/a/'), '/news/2018/a/')
+        self.assertEqual(path_redirects.get('/bar/'), '/b/')
+        self.assertIsNone(path_redirects.get('/a/'))
+        self.assertIsNone(path_redirects.get('/c/'))
+        self.assertIsNone(path_redirects.get('/old'))
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        csv_path = os.path.join(directory, 'redirects.csv')
+        with open(csv_path, 'w') as f:
+            f.write('# source,target\n/old/,/new/\n/shop/*,https://shop.example.com/*\n')
+        json_path = os.path.join(directory, 'redirects.json')
+        with open(json_path, 'w') as f:
+            json.dump({'/other/': '/new-other/'}, f)
+        self.assertEqual(paths.load_path_redirects(json_path).get('/other/'), '/new-other/')
+        broken_path = os.path.join(directory, 'broken.csv')
+        with open(broken_path, 'w') as f:
+            f.write('# source,target\n/old/,/new/\n\n/missing-target/\n')
+        with self.assertRaises(ImproperlyConfigured) as cm:
+            paths.load_path_redirects(broken_path)
+        self.assertIn('{}, line 4: expected a source and a target'.format(broken_path), str(cm.exception))
+        with open(json_path, 'w') as f:
+            json.dump([['/a/', '/b/'], ['/c/']], f)
+        with self.assertRaises(ImproperlyConfigured) as cm:
+            paths.load_path_redirects(json_path)
+        self.assertIn('{}, entry 1: expected a source and a target'.format(json_path), str(cm.exception))
+
+        config = {'domain': 'www.default.com', 'redirects': ['default.com']}
+        with self.settings(ALDRYN_SITES_DOMAINS={1: config}, ALDRYN_SITES_PATH_REDIRECTS={1: csv_path}):
+            site_middleware = middleware.SiteMiddleware()
+        expected_redirects = [
+            ('http://www.default.com/old/?a=b', 'http://www.default.com/new/?a=b'),
+            ('http://default.com/old/', 'http://www.default.com/new/'),
+            ('http://default.com/other/', 'http://www.default.com/other/'),
+            ('http://www.default.com/shop/a/', 'https://shop.example.com/a/'),
+            ('http://www.default.com/other/', None),
+        ]
+        for src, expected in expected_redirects:
+            response = site_middleware.process_request(self.request_from_url(src))
+            if expected is None:
+                self.assertIsNone(response)
+            else:
+                self.assertUrlEquals(src, expected, response['Location'])
+
+    def test_redirect_response(self):
+        config = {'domain': 'www.default.com', 'redirects': ['default.com']}
+        request = self.factory.get('/a/', HTTP_HOST='default.com')
+        with self.settings(
+            ALDRYN_SITES_DOMAINS={1: config},
+            ALDRYN_SITES_REDIRECT_CACHE_CONTROL='public, max-age=86400',
+            ALDRYN_SITES_REDIRECT_VARY=['X-Forwarded-Proto'],
+        ):
+            response = middleware.SiteMiddleware().process_request(request)
+            # only permanent redirects are cacheable
+            self.assertEqual(response.status_code, 302)
+            self.assertFalse(response.has_header('Cache-Control'))
+            self.assertFalse(response.has_header('Vary'))
+
+            with self.settings(ALDRYN_SITES_REDIRECT_PERMANENT=True):
+                response = middleware.SiteMiddleware().process_request(request)
+            self.assertEqual(response.status_code, 301)
+            self.assertEqual(response['Location'], 'http://www.default.com/a/')
+            self.assertEqual(response['Cache-Control'], 'public, max-age=86400')
+            self.assertEqual(response['Vary'], 'X-Forwarded-Proto')
+
+    @skipIf(DJANGO_VERSION < (3, 1), "Async middleware requires Django 3.1")
+    def test_async_middleware(self):
+        import asyncio
+        from asgiref.sync import sync_to_async
+        from django.http import HttpResponse
+
+        threads = []
+
+        class ThreadRecordingSiteMiddleware(middleware.SiteMiddleware):
+            def process_request(self, request):
+                threads.append(threading.current_thread())
+                return super(ThreadRecordingSiteMiddleware, self).process_request(request)
+
+        get_response = sync_to_async(lambda request: HttpResponse('ok'))
+        with self.settings(
+            ALDRYN_SITES_DOMAINS={1: {'domain': 'www.default.com', 'redirects': ['default.com']}},
+            SECURE_SSL_REDIRECT=None,
+        ):
+            site_middleware = ThreadRecordingSiteMiddleware(get_response)
+        self.assertTrue(site_middleware.is_async())
+
+        loop = asyncio.new_event_loop()
+        try:
+            response = loop.run_until_complete(site_middleware(self.request_from_url('http://default.com/a/')))
+            self.assertEqual(response['Location'], 'http://www.default.com/a/')
+            response = loop.run_until_complete(site_middleware(self.request_from_url('http://www.default.com/')))
+            self.assertEqual(response.content, b'ok')
+        finally:
+            loop.close()
+        self.assertEqual(threads, [threading.current_thread()] * 2)
+
+    def test_stats(self):
+        config = {
+            'domain': 'www.default.com',
+            'aliases': [r'^[a-z]+\.default\.me$'],
+            'redirects': ['default.com', r'^[a-z]+\.default\.io$'],
+        }
+        with self.settings(
+            ALDRYN_SITES_DOMAINS={1: config},
+            ALDRYN_SITES_STATS=True,
+            ALDRYN_SITES_STATS_HOOK='aldryn_sites.tests.record_decision',
+            SECURE_SSL_REDIRECT=True,
+        ):
+            site_middleware = middleware.SiteMiddleware()
+        del recorded_decisions[:]
+        for url in [
+            'https://www.default.com/',
+            'http://www.default.com/',
+            'https://default.com/',
+            'https://foo.default.io/',
+            'https://foo.default.me/',
+            'http://foo.default.me/',
+            'https://unknown.com/',
+            'https://unknown.com/',
+            'https://127.0.0.1/',
+        ]:
+            site_middleware.process_request(self.request_from_url(url))
+
+        snapshot = site_middleware.stats.snapshot()
+        self.assertEqual(snapshot['branches'], {
+            'exact_alias': 1,
+            'scheme_redirect': 1,
+            'exact_redirect': 1,
+            'pattern_redirect': 1,
+            'pattern_alias': 1,
+            'pattern_scheme_redirect': 1,
+            'no_match': 2,
+            'ip': 1,
+        })
+        self.assertEqual(sum(count for bound, count in snapshot['latency']), 9)
+        self.assertEqual(dict(snapshot['top_pattern_hosts']), {
+            'foo.default.io': 1,
+            'foo.default.me': 2,
+            'unknown.com': 2,
+        })
+        self.assertEqual(len(recorded_decisions), 9)
+        self.assertEqual(recorded_decisions[2], ('exact_redirect', 'default.com'))
+
+    def test_decision_cache(self):
+        config = {
+            'domain': 'www.default.com',
+            'redirects': ['default.com'],
+        }
+        with self.settings(
+            ALDRYN_SITES_DOMAINS={1: config},
+            ALDRYN_SITES_DECISION_CACHE_SIZE=2,
+            SECURE_SSL_REDIRECT=True,
+        ):
+            site_middleware = middleware.SiteMiddleware()
+        cache = site_middleware.decision_cache
+
+        response = site_middleware.process_request(self.request_from_url('http://default.com/a/'))
+        self.assertEqual(response['Location'], 'https://www.default.com/a/')
+        # the path is not part of the cached decision
+        response = site_middleware.process_request(self.request_from_url('http://default.com/b/?c=d'))
+        self.assertEqual(response['Location'], 'https://www.default.com/b/?c=d')
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        # unknown hosts are cached as well
+        self.assertIsNone(site_middleware.process_request(self.request_from_url('http://unknown.com/')))
+        self.assertIsNone(site_middleware.process_request(self.request_from_url('http://unknown.com/')))
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+        # the least recently used decision is evicted
+        site_middleware.process_request(self.request_from_url('http://www.default.com/'))
+        self.assertEqual(len(cache), 2)
+        site_middleware.process_request(self.request_from_url('http://default.com/'))
+        self.assertEqual((cache.hits, cache.misses), (2, 4))
+
+        # a request that started before a reload keeps its router and cache
+        state = site_middleware.state
+        site_middleware.set_router(SitesRouter({1: {'domain': 'www.default.com'}}, https=True))
+        self.assertEqual(site_middleware.resolve('default.com', 'http', state)[2], ('https', 'www.default.com'))
+        self.assertEqual(len(site_middleware.decision_cache), 0)
+        self.assertIsNone(site_middleware.resolve('default.com', 'http')[2])
+
+    def test_multisite(self):
+        Site.objects.all().delete()
+        domains = {
+            1: {
+                'name': 'Site 1',
+                'domain': 'www.site1.com',
+                'aliases': ['shared.com'],
+                'redirects': ['site1.com', r'^[a-z]+\.site1\.com$'],
+            },
+            2: {
+                'name': 'Site 2',
+                'domain': 'www.site2.com',
+                'redirects': ['site2.com', 'shared.com'],
+            },
+        }
+        with self.settings(
+            ALDRYN_SITES_DOMAINS=domains,
+            ALDRYN_SITES_MULTISITE=True,
+            SECURE_SSL_REDIRECT=None,
+            SITE_ID=1,
+        ):
+            utils.set_site_names(force=True)
+            site_middleware = middleware.SiteMiddleware()
+
+        expected = [
+            ('http://www.site1.com/', 1, None),
+            ('http://site1.com/a/', 1, 'http://www.site1.com/a/'),
+            ('http://foo.site1.com/', 1, 'http://www.site1.com/'),
+            ('https://www.site2.com/', 2, None),
+            ('https://site2.com/', 2, 'https://www.site2.com/'),
+            # an alias of site 1 wins over a redirect of site 2
+            ('http://shared.com/', 1, None),
+            # unknown hosts belong to SITE_ID
+            ('http://unknown.com/', 1, None),
+        ]
+        for src, site_id, location in expected:
+            request = self.request_from_url(src)
+            response = site_middleware.process_request(request)
+            self.assertEqual(request.site_id, site_id)
+            self.assertEqual(request.site.pk, site_id)
+            if location is None:
+                self.assertIsNone(response)
+            else:
+                self.assertUrlEquals(src, location, response['Location'])
+
+    def test_redirect_chains(self):
+        domains = {
+            1: {'domain': 'www.site1.com', 'redirects': ['site1.com', 'www.site2.com']},
+            2: {'domain': 'www.site2.com', 'aliases': ['site2.org'], 'redirects': ['site2.com', '*.site2.com']},
+            3: {'domain': 'www.site3.com', 'redirects': ['site3.com', 'www.site1.com']},
+        }
+        router = SitesRouter(domains, https=True)
+        # site 2 moved to site 1, which moved to site 3
+        self.assertEqual(router.routers[2].redirect_domain, 'www.site3.com')
+        self.assertEqual(router.routers[1].redirect_domain, 'www.site3.com')
+        self.assertEqual(router.routers[3].redirect_domain, 'www.site3.com')
+        expected = [
+            ('http://site2.com/', 'https://www.site3.com/'),
+            ('http://foo.site2.com/', 'https://www.site3.com/'),
+            ('https://www.site2.com/', 'https://www.site3.com/'),
+            ('http://www.site1.com/', 'https://www.site3.com/'),
+            ('http://www.site3.com/', 'https://www.site3.com/'),
+            # aliases of a moved site are kept
+            ('http://site2.org/', 'https://site2.org/'),
+            ('https://site2.org/', None),
+        ]
+        for src, location in expected:
+            url = yurl.URL(src)
+            target = router.resolve_site(url.host, url.scheme)[2]
+            self.assertUrlEquals(src, location, '{}://{}/'.format(*target) if target else None)
+        # the router of a single site redirects in one step as well
+        self.assertEqual(router.routers[2].get_redirect_url('http://site2.com/a/'), 'https://www.site3.com/a/')
+        self.assertEqual(router.hosts['www.site2.com'], 1)
+        self.assertEqual(router.hosts['www.site1.com'], 3)
+
+        domains[2]['redirects'].append('www.site3.com')
+        with self.assertRaises(ImproperlyConfigured) as cm:
+            SitesRouter(domains)
+        self.assertIn(
+            'www.site1.com (site 1) -> www.site3.com (site 3) -> www.site2.com (site 2) -> www.site1.com (site 1)',
+            str(cm.exception),
+        )
+
+    def test_validate_domains(self):
+        conf.validate_domains({
+            1: {
+                'name': 'Site 1',
+                'domain': 'www.default.com',
+                'aliases': ['*.default.com', r'^[a-z]+\.default\.io$'],
+                'redirects': ['*', re.compile(r'^.*$')],
+            },
+        })
+        invalid = [
+            ([], 'must be a dict of site id'),
+            ({1: 'www.default.com'}, "ALDRYN_SITES_DOMAINS[1] must be a dict"),
+            ({1: {'aliases': []}}, "ALDRYN_SITES_DOMAINS[1]['domain'] must be a domain name"),
+            ({1: {'domain': '*.default.com'}}, "ALDRYN_SITES_DOMAINS[1]['domain'] must be a domain name"),
+            ({1: {'domain': r'^(www\.)?default\.com$'}}, "ALDRYN_SITES_DOMAINS[1]['domain'] must be a domain name"),
+            ({1: {'domain': 'default.com', 'alias': []}}, "ALDRYN_SITES_DOMAINS[1] has unknown keys: 'alias'"),
+            ({2: {'domain': 'default.com', 'name': 1}}, "ALDRYN_SITES_DOMAINS[2]['name'] must be a string"),
+            ({2: {'domain': 'default.com', 'aliases': 'a.com'}}, "ALDRYN_SITES_DOMAINS[2]['aliases'] must be a list"),
+            ({2: {'domain': 'default.com', 'redirects': [None]}},
+             "ALDRYN_SITES_DOMAINS[2]['redirects'] contains an invalid entry: None"),
+            ({2: {'domain': 'default.com', 'redirects': ['^[a-z+$']}},
+             "ALDRYN_SITES_DOMAINS[2]['redirects'] contains an invalid regex '^[a-z+$'"),
+            # not a wildcard without a suffix
+            ({2: {'domain': 'default.com', 'aliases': ['*.']}},
+             "ALDRYN_SITES_DOMAINS[2]['aliases'] contains an invalid regex '*.'"),
+        ]
+        for domains, message in invalid:
+            with self.assertRaises(ImproperlyConfigured) as cm:
+                conf.validate_domains(domains)
+            self.assertIn(message, str(cm.exception))
+
+    def test_router_compiled_at_startup(self):
+        site_middleware = middleware.SiteMiddleware()
+        self.assertIs(site_middleware.router, settings.ALDRYN_SITES_ROUTER.routers[1])
+        with self.settings(ALDRYN_SITES_DOMAINS={1: {'domain': 'www.default.com'}}):
+            site_middleware = middleware.SiteMiddleware()
+        self.assertEqual(site_middleware.router.domain, 'www.default.com')
+
+    def test_router_snapshot(self):
+        domains = {
+            1: {
+                'domain': 'www.default.com',
+                'aliases': ['alias.default.com', r'^[a-z]+\.alias\.com$'],
+                'redirects': ['default.com', '*.old.com', re.compile(r'^[a-z]+\.redirect\.com$')],
+            },
+        }
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'router.pickle')
+        self.assertIsNone(snapshot.load_snapshot(path, domains))
+
+        router = snapshot.get_router(path, domains, https=True)
+        self.assertTrue(os.path.exists(path))
+        loaded = snapshot.load_snapshot(path, domains, https=True)
+        self.assertIsNot(loaded, router)
+        self.assertTrue(loaded.is_built_from(domains, https=True))
+        # regexes are only compiled when they are needed
+        self.assertIsNotNone(loaded.routers[1].patterns.sources)
+        self.assertEqual(loaded.resolve_site('alias.default.com', 'https'), (1, 'exact_alias', None))
+        self.assertIsNotNone(loaded.routers[1].patterns.sources)
+        for host in ('foo.alias.com', 'foo.redirect.com', 'foo.old.com', 'unknown.com'):
+            self.assertEqual(loaded.resolve_site(host, 'http'), router.resolve_site(host, 'http'))
+        self.assertIsNone(loaded.routers[1].patterns.sources)
+        self.assertEqual(
+            [pattern.pattern for pattern in loaded.routers[1].redirect_domain_patterns],
+            [r'^[a-z]+\.redirect\.com$'],
+        )
+        self.assertTrue(loaded.routers[1].patterns.redirect_hosts.match('default.com.other.org'))
+
+        # a different config makes the snapshot stale
+        self.assertIsNone(snapshot.load_snapshot(path, domains, https=False))
+        changed = {1: dict(domains[1], aliases=['alias.default.com'])}
+        self.assertIsNone(snapshot.load_snapshot(path, changed, https=True))
+        router = snapshot.get_router(path, changed, https=True)
+        self.assertTrue(snapshot.load_snapshot(path, changed, https=True).is_built_from(changed, https=True))
+
+        # a router that was loaded but not compiled yet can be written again
+        loaded = snapshot.load_snapshot(path, changed, https=True)
+        snapshot.save_snapshot(loaded, path)
+        loaded = snapshot.load_snapshot(path, changed, https=True)
+        loaded.compile()
+        self.assertEqual(
+            loaded.resolve_site('foo.old.com', 'https'),
+            (1, 'pattern_redirect', ('https', 'www.default.com')),
+        )
+
+    def test_allowed_hosts(self):
+        self.assertEqual(hosts.get_allowed_host('www.default.com'), 'www.default.com')
+        self.assertEqual(hosts.get_allowed_host('*.default.com'), '.default.com')
+        self.assertEqual(hosts.get_allowed_host('*'), '*')
+        # only one label, .default.com would allow any number
+        self.assertIsNone(hosts.get_allowed_host(r'^[a-z0-9-]+\.default\.com$'))
+        self.assertEqual(hosts.get_allowed_host(re.compile(r'^.+\.default\.com$')), '.default.com')
+        self.assertIsNone(hosts.get_allowed_host(r'^(www|shop)\.default\.com$'))
+        # also matches default.com.other.org
+        self.assertIsNone(hosts.get_allowed_host(r'^[a-z0-9-]+\.default\.com'))
+        self.assertEqual(
+            hosts.get_allowed_hosts({
+                1: {'domain': 'www.default.com', 'aliases': ['*.default.com'], 'redirects': ['localhost', '^.*$']},
+                2: {'domain': 'www.other.com', 'aliases': ['www.default.com']},
+            }, ['localhost']),
+            ['localhost', 'www.default.com', '.default.com', 'www.other.com'],
+        )
+
+    def test_host_validation(self):
+        domains = {
+            1: {'domain': 'www.default.com', 'aliases': ['*.default.me'], 'redirects': [r'^[a-z]+\.default\.io$']},
+            2: {'domain': 'www.other.com'},
+        }
+        with self.settings(
+            ALDRYN_SITES_DOMAINS=domains,
+            ALDRYN_SITES_VALIDATE_HOSTS=True,
+            ALLOWED_HOSTS=['*', 'localhost', '.example.com'],
+            SECURE_SSL_REDIRECT=None,
+        ):
+            site_middleware = middleware.SiteMiddleware()
+        for host in ['www.default.com', 'WWW.default.com', 'foo.default.me', 'foo.default.io', 'www.other.com',
+                     'localhost', 'example.com', 'www.example.com:8000']:
+            response = site_middleware.process_request(self.factory.get('/', HTTP_HOST=host))
+            self.assertTrue(response is None or response.status_code == 302, host)
+        for host in ['default.com', '1.default.io', 'unknown.com', 'localhost.com', 'www.default.com.evil.com',
+                     'www.other.com.evil.com', 'foo.default.io.evil.com', r'^[a-z]+\.default\.io$',
+                     'www.default.com:x']:
+            response = site_middleware.process_request(self.factory.get('/', HTTP_HOST=host))
+            self.assertEqual(response.status_code, 400, host)
+
+    def test_host_validator_whole_hosts(self):
+        validator = hosts.HostValidator(SitesRouter({
+            1: {'domain': 'www.project.com', 'aliases': ['an.other.domain.com'], 'redirects': ['project.com']},
+            2: {'domain': 'www.other.com', 'aliases': [r'^[a-z]+\.other\.com', r'^shop|store\.other\.org$']},
+        }), ['*'])
+        for host in ['www.project.com', 'project.com', 'an.other.domain.com', 'foo.other.com', 'store.other.org']:
+            self.assertTrue(validator(host), host)
+        for host in ['www.project.com.evil.com', 'project.com.attacker.net', 'foo.other.com.evil.com',
+                     'shop.evil.com', r'^[a-z]+\.other\.com']:
+            self.assertFalse(validator(host), host)
+
+        # the regexes of many sites are checked with a few combined regexes, in the order of the sites
+        sites_router = SitesRouter(dict(
+            (site_id, {
+                'domain': 'www.site{}.com'.format(site_id),
+                'aliases': [r'^[a-z]+\.site{}\.com$'.format(site_id)],
+            })
+            for site_id in range(1, 121)
+        ))
+        sites_router.routers[60] = SiteRouter(
+            {'domain': 'www.site60.com', 'aliases': [re.compile(r'^[a-z]+\.site60\.com$', re.I)]}, site_id=60)
+        sites_router.routers[70] = SiteRouter(
+            {'domain': 'www.site70.com', 'aliases': [r'^.*\.site1\.com$']}, site_id=70)
+        self.assertEqual(len(sites_router.get_host_regexes()), 5)
+        self.assertEqual(sites_router.find_host_site_id('foo.site1.com'), 1)
+        self.assertEqual(sites_router.find_host_site_id('FOO.site60.com'), 60)
+        self.assertEqual(sites_router.find_host_site_id('foo.site120.com'), 120)
+        self.assertEqual(sites_router.find_host_site_id('a.b.site1.com'), 70)
+        self.assertIsNone(sites_router.find_host_site_id('foo.site1.com.evil.com'))
+
     @skipIf(DJANGO_VERSION >= (1, 7),
             "Does not work inside tests on this version")
     def test_auto_configure_allowed_hosts(self):
-        from django.conf import settings
         for domain in ['www.project.com', 'project.com', 'an.other.domain.com']:
             self.assertIn(domain, settings.ALLOWED_HOSTS)
 
@@ -334,3 +959,475 @@ class AldrynSitesTestCase(TestCase):
             s = Site.objects.get(id=site_2.pk)
             self.assertEquals(s.name, 'Site 2')
             self.assertEquals(s.domain, 'other-site2.com')
+
+    def test_sync_sites_command(self):
+        Site.objects.all().delete()
+        Site.objects.create(id=1, name='Site 1', domain='old-site1.com')
+        with self.settings(ALDRYN_SITES_DOMAINS={
+            1: {'domain': 'site1.com'},
+            2: {'name': 'Site 2', 'domain': 'site2.com'},
+        }):
+            out = StringIO()
+            call_command('sync_sites', dry_run=True, stdout=out)
+            self.assertIn('+ 2 site2.com (Site 2)', out.getvalue())
+            self.assertIn('~ 1 site1.com', out.getvalue())
+            self.assertEqual(Site.objects.get(id=1).domain, 'old-site1.com')
+            self.assertFalse(Site.objects.filter(id=2).exists())
+
+            call_command('sync_sites', stdout=StringIO())
+            self.assertEqual(Site.objects.get(id=1).domain, 'site1.com')
+            self.assertEqual(Site.objects.get(id=1).name, 'Site 1')
+            self.assertEqual(Site.objects.get(id=2).name, 'Site 2')
+
+            out = StringIO()
+            call_command('sync_sites', stdout=out)
+            self.assertIn('0 sites created, 0 updated.', out.getvalue())
+
+    def test_export_redirects(self):
+        domains = {
+            1: {
+                'domain': 'www.default.com',
+                'aliases': ['alias.default.com', '*.customers.com', r'^[a-z]+\.alias\.com$'],
+                'redirects': ['default.com', 'www.other.com', '*.old.customers.com', r'^[a-z]+\.redirect\.com$'],
+            },
+            2: {
+                'domain': 'www.other.com',
+                'redirects': ['other.com', '*.customers.com', '*'],
+            },
+        }
+        router = SitesRouter(domains, https=True, default_site_id=1)
+        rules = export.get_rules(router)
+        self.assertEqual(
+            [(rule.kind, rule.key) for rule in rules],
+            [
+                ('exact', 'alias.default.com'),
+                ('exact', 'default.com'),
+                ('exact', 'other.com'),
+                ('exact', 'www.default.com'),
+                ('exact', 'www.other.com'),
+                ('wildcard', 'old.customers.com'),
+                # limited to the hosts of the alias wildcard
+                ('regex', r'^(?=.+\.customers\.com$)(?:^[a-z]+\.redirect\.com$)'),
+                ('wildcard', 'customers.com'),
+                ('wildcard', ''),
+                ('regex', r'^[a-z]+\.redirect\.com$'),
+                ('regex', r'^[a-z]+\.alias\.com$'),
+            ],
+        )
+        self.assertEqual(rules[3].targets, {'http': ('https', 'www.default.com'), 'https': None})
+        self.assertEqual(rules[7].targets, {'http': ('https', None), 'https': None})
+        hosts = [
+            'www.default.com', 'alias.default.com', 'default.com', 'www.other.com', 'other.com',
+            'a.customers.com', 'a.old.customers.com', 'foo.redirect.com', 'foo.alias.com', 'unknown.org', '10.0.0.1',
+        ]
+        self.assertEqual(export.verify(rules, router, hosts), [])
+        # plain hosts are not exported as regexes
+        self.assertEqual(
+            export.verify(export.get_rules(router.routers[1]), router.routers[1], ['default.com.example.org']),
+            [
+                ('default.com.example.org', 'http', 'https://www.default.com', None),
+                ('default.com.example.org', 'https', 'https://www.default.com', None),
+            ],
+        )
+
+        nginx = export.render_nginx(rules, status=301)
+        self.assertIn('    default.com "https://www.default.com";', nginx)
+        self.assertIn('    *.old.customers.com "https://www.default.com";', nginx)
+        # nginx checks masks before regexes, so a wildcard after a regex is a regex too
+        self.assertIn('    "~^.+\\.customers\\.com$" "https://$host";', nginx)
+        self.assertNotIn('*.customers.com', nginx)
+        for export_format in export.FORMATS:
+            self.assertEqual(export.verify(rules, router, hosts, export_format), [], export_format)
+        # www.other.com is a redirect of site 1, so site 2 redirects there too
+        self.assertIn('    "~." "https://www.default.com";', nginx)
+        self.assertIn('return 301 $aldryn_sites_redirect$request_uri;', nginx)
+        haproxy = export.render_haproxy(rules)
+        self.assertIn('alias.default.com https://alias.default.com\n', haproxy['aldryn_sites_http.map'])
+        self.assertIn('^.+\\.customers\\.com$ https://\n', haproxy['aldryn_sites_http_reg.map'])
+        self.assertIn('alias.default.com -\n', haproxy['aldryn_sites_https.map'])
+        self.assertIn('^.+\\.customers\\.com$ -\n', haproxy['aldryn_sites_https_reg.map'])
+        vcl = export.render_vcl(rules)
+        self.assertIn('set req.http.X-Aldryn-Sites-Location = "https://" + req.http.X-Aldryn-Sites-Host;', vcl)
+
+        with self.settings(ALDRYN_SITES_DOMAINS=domains, SECURE_SSL_REDIRECT=True, ALDRYN_SITES_MULTISITE=True):
+            out = StringIO()
+            call_command('export_redirects', 'nginx', stdout=out)
+            self.assertEqual(out.getvalue(), export.render_nginx(rules))
+
+            directory = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, directory)
+            call_command('export_redirects', 'haproxy', output_dir=directory, stdout=StringIO())
+            self.assertEqual(sorted(os.listdir(directory)), sorted(haproxy.keys()))
+
+            hosts_file = os.path.join(directory, 'hosts.txt')
+            with open(hosts_file, 'w') as f:
+                f.write('\n'.join(hosts))
+            out = StringIO()
+            call_command('export_redirects', 'nginx', verify=hosts_file, stdout=out)
+            self.assertIn('11 hosts verified.', out.getvalue())
+            out = StringIO()
+            call_command('export_redirects', verify=hosts_file, stdout=out)
+            self.assertIn('11 hosts verified.', out.getvalue())
+            with self.assertRaises(CommandError):
+                call_command('export_redirects', stdout=StringIO())
+
+    def test_export_nginx_order(self):
+        router = SiteRouter({
+            'domain': 'www.example.com',
+            'aliases': ['*.example.com'],
+            'redirects': [r'^old\.example\.com$'],
+        })
+        rules = export.get_rules(router)
+        hosts = ['old.example.com', 'foo.example.com']
+        self.assertEqual(export.verify(rules, router, hosts, export.NGINX), [])
+        nginx = export.render_nginx(rules)
+        self.assertLess(nginx.index('old'), nginx.index('"~^.+\\.example\\.com$"'))
+        # as nginx would check the rules with a mask for the wildcard
+        masked = [rule for rule in rules if rule.kind == export.WILDCARD] + [
+            rule for rule in rules if rule.kind != export.WILDCARD]
+        self.assertEqual(
+            export.verify(masked, router, hosts),
+            [('old.example.com', 'http', 'http://www.example.com', None),
+             ('old.example.com', 'https', 'https://www.example.com', None)],
+        )
+
+    def test_export_compiled_regexes(self):
+        router = SitesRouter({
+            1: {'domain': 'www.default.com', 'redirects': ['default.com', re.compile(r'^[a-z]+\.default\.io$')]},
+            2: {'domain': 'www.other.com', 'aliases': [re.compile(r'^[a-z]+\.other\.com$')]},
+        }, https=True)
+        rules = export.get_rules(router)
+        self.assertEqual(
+            [(rule.kind, rule.key) for rule in rules],
+            [
+                ('exact', 'default.com'),
+                ('exact', 'www.default.com'),
+                ('exact', 'www.other.com'),
+                ('regex', r'^[a-z]+\.default\.io$'),
+                ('regex', r'^[a-z]+\.other\.com$'),
+            ],
+        )
+        self.assertEqual(export.verify(rules, router, ['foo.default.io', 'foo.other.com']), [])
+        self.assertEqual(replay.Replayer(router).replay(['foo.default.io http /']).requests, 1)
+
+    def test_replay_log(self):
+        self.assertEqual(
+            replay.parse_line('www.a.com:443 1.2.3.4 - - [10/Oct/2020:13:55:36 +0200] "GET / HTTP/1.1" 200 5 "-" "ua"'),
+            ('www.a.com', 'https'),
+        )
+        # the trailing host field wins over the vhost
+        self.assertEqual(
+            replay.parse_line('1.2.3.4 - - [10/Oct/2020:13:55:36 +0200] "GET / HTTP/1.1" 200 5 "-" "ua" "a.com"'),
+            ('a.com', 'http'),
+        )
+        self.assertIsNone(replay.parse_line('1.2.3.4 - - [10/Oct/2020:13:55:36 +0200] "GET / HTTP/1.1" 200 5 "-" "ua"'))
+        self.assertEqual(replay.parse_line('a.com https /path'), ('a.com', 'https'))
+        self.assertEqual(replay.parse_line('HTTPS://a.com/path'), ('a.com', 'https'))
+
+        domains = {
+            1: {
+                'domain': 'www.default.com',
+                'aliases': ['*.customers.com', r'^[a-z]+\.alias\.com$'],
+                'redirects': ['default.com', 'old.com'],
+            },
+        }
+        proposed = {1: {'domain': 'www.default.com', 'redirects': ['default.com', '*.customers.com']}}
+        lines = [
+            'www.default.com https /',
+            'default.com http /',
+            'a.customers.com https /',
+            'foo.alias.com https /',
+            'foo.alias.com http /',
+            '10.0.0.1 http /',
+            '',
+        ]
+        with self.settings(ALDRYN_SITES_DOMAINS=domains, SECURE_SSL_REDIRECT=True):
+            replayer = replay.Replayer(loader.get_middleware_router())
+        report = replayer.replay(lines)
+        self.assertEqual((report.requests, report.skipped), (6, 1))
+        self.assertEqual(report.branches['exact_alias'], 1)
+        self.assertEqual(report.branches['exact_redirect'], 1)
+        self.assertEqual(report.branches['pattern_alias'], 2)
+        self.assertEqual(report.branches['pattern_scheme_redirect'], 1)
+        self.assertEqual(report.branches['ip'], 1)
+        self.assertEqual(report.regex_hosts, {'foo.alias.com': 2})
+        self.assertEqual([rule.key for rule in replayer.get_unused_rules(report)], ['old.com'])
+        # the same results from several processes
+        parallel = replay.replay_parallel(replayer, lines * 10, processes=2, chunk_size=4)
+        self.assertEqual(parallel.branches, dict((key, value * 10) for key, value in report.branches.items()))
+        self.assertEqual(parallel.rule_hits, Counter(dict(
+            (key, value * 10) for key, value in report.rule_hits.items())))
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        log = os.path.join(directory, 'access.log.gz')
+        with gzip.open(log, 'wb') as f:
+            f.write('\n'.join(lines).encode('utf-8'))
+        domains_file = os.path.join(directory, 'domains.json')
+        with open(domains_file, 'w') as f:
+            json.dump(proposed, f)
+        out = StringIO()
+        with self.settings(ALDRYN_SITES_DOMAINS=domains, SECURE_SSL_REDIRECT=True):
+            call_command('replay_log', log, domains=domains_file, stdout=out)
+        output = out.getvalue()
+        self.assertIn('6 requests, 0 lines skipped.', output)
+        self.assertIn('2 requests would be redirected differently:', output)
+        self.assertIn('https://a.customers.com: no redirect -> https://www.default.com (1)', output)
+        self.assertIn('http://foo.alias.com: https://foo.alias.com -> no redirect (1)', output)
+
+    def test_canonicalize_urls(self):
+        router = SitesRouter({
+            1: {
+                'domain': 'www.default.com',
+                'aliases': ['*.customers.com'],
+                'redirects': ['default.com', r'^[a-z]+\.redirect\.com$'],
+            },
+            2: {'domain': 'www.other.com', 'redirects': ['other.com']},
+        }, https=True, default_site_id=1)
+        urls = [
+            'http://default.com/a/?b=1\n',
+            'https://default.com/c/',
+            'https://www.default.com/d/',
+            'http://foo.customers.com/',
+            'http://foo.redirect.com/e/',
+            'http://Other.COM./f/',
+            'http://10.0.0.1/',
+            'http://unknown.org/',
+            '/relative/',
+            'http://default.com:80/g/',
+            'http://default.com:8000/h/',
+        ]
+        expected = [
+            'https://www.default.com/a/?b=1',
+            'https://www.default.com/c/',
+            'https://www.default.com/d/',
+            'https://foo.customers.com/',
+            'https://www.default.com/e/',
+            'https://www.other.com/f/',
+            'http://10.0.0.1/',
+            'http://unknown.org/',
+            '/relative/',
+            # default ports are dropped, like in SiteMiddleware
+            'https://www.default.com/g/',
+            'https://www.default.com:8000/h/',
+        ]
+        result = canonical.canonicalize_urls(iter(urls), router)
+        self.assertFalse(isinstance(result, list))
+        self.assertEqual(list(result), expected)
+
+        # the decision for a host is only computed once
+        canonicalizer = canonical.Canonicalizer(router)
+        list(canonicalizer.canonicalize_many(['http://default.com/{}/'.format(i) for i in range(10)]))
+        self.assertEqual(canonicalizer.decisions, {('default.com', 'http'): ('https', 'www.default.com')})
+
+        self.assertEqual(
+            list(canonical.canonicalize_urls(urls * 5, router, processes=2, chunk_size=4)),
+            expected * 5,
+        )
+
+    def test_sync_sites_once(self):
+        Site.objects.all().delete()
+        with self.settings(ALDRYN_SITES_DOMAINS={1: {'domain': 'site1.com'}}):
+            # only loads the sites, without syncing them
+            with self.assertNumQueries(1):
+                middleware.SiteMiddleware()
+            self.assertFalse(Site.objects.exists())
+
+            # another process is syncing
+            cache.add(utils.SYNC_LOCK_KEY, True, 60)
+            self.addCleanup(cache.delete, utils.SYNC_LOCK_KEY)
+            self.assertIsNone(utils.sync_sites_once())
+            out = StringIO()
+            call_command('sync_sites', stdout=out)
+            self.assertIn('skipped', out.getvalue())
+            self.assertFalse(Site.objects.exists())
+
+            cache.delete(utils.SYNC_LOCK_KEY)
+            created, updated = utils.sync_sites_once()
+            self.assertEqual([site.domain for site in created], ['site1.com'])
+            self.assertIsNone(cache.get(utils.SYNC_LOCK_KEY))
+
+            # on migrate
+            Site.objects.all().delete()
+            with self.settings(ALDRYN_SITES_SET_DOMAIN_NAME=False):
+                apps.sync_sites(using='default')
+            self.assertFalse(Site.objects.exists())
+            apps.sync_sites(using='default')
+            self.assertEqual(Site.objects.get(id=1).domain, 'site1.com')
+
+    def test_prewarm_site_cache(self):
+        Site.objects.all().delete()
+        Site.objects.create(id=1, name='Site 1', domain='site1.com')
+        domains = {
+            1: {'domain': 'site1.com'},
+            2: {'name': 'Site 2', 'domain': 'site2.com'},
+        }
+        with self.settings(ALDRYN_SITES_DOMAINS=domains, ALDRYN_SITES_SITE_CACHE='default'):
+            Site.objects.clear_cache()
+            self.assertFalse(utils.prewarm_site_cache_from_shared_cache())
+            utils.sync_sites()
+            with self.assertNumQueries(0):
+                self.assertEqual(Site.objects.get_current().domain, 'site1.com')
+                self.assertEqual(Site.objects._get_site_by_id(2).name, 'Site 2')
+
+            # another process gets the sites from the shared cache
+            Site.objects.clear_cache()
+            utils._has_set_site_names = False
+            with self.assertNumQueries(0):
+                utils.set_site_names()
+                self.assertEqual(Site.objects._get_site_by_id(2).domain, 'site2.com')
+
+            # a different config needs a sync
+            domains[2] = {'domain': 'other-site2.com'}
+            self.assertFalse(utils.prewarm_site_cache_from_shared_cache())
+            utils.sync_sites()
+            self.assertTrue(utils.prewarm_site_cache_from_shared_cache())
+
+            # saving a site invalidates the shared cache
+            Site.objects.filter(id=1).get().save()
+            self.assertFalse(utils.prewarm_site_cache_from_shared_cache())
+
+        # without a shared cache, a worker loads the sites with one query
+        with self.settings(ALDRYN_SITES_DOMAINS=domains):
+            Site.objects.clear_cache()
+            with self.assertNumQueries(1):
+                middleware.SiteMiddleware()
+            with self.assertNumQueries(0):
+                self.assertEqual(Site.objects.get_current().domain, 'site1.com')
+                self.assertEqual(Site.objects._get_site_by_id(2).domain, 'other-site2.com')
+
+    def test_database_domains(self):
+        Site.objects.all().delete()
+        site_1 = Site.objects.create(id=1, name='Site 1', domain='www.default.com')
+        site_2 = Site.objects.create(id=2, name='Site 2', domain='www.other.com')
+        SiteDomain.objects.create(site=site_1, domain='default.com', type=SiteDomain.REDIRECT)
+        with self.settings(
+            ALDRYN_SITES_DOMAINS={1: {'domain': 'www.default.com', 'redirects': ['default.io']}},
+            ALDRYN_SITES_DATABASE_DOMAINS=True,
+            ALDRYN_SITES_RELOAD_INTERVAL=0,
+            ALDRYN_SITES_MULTISITE=True,
+            SECURE_SSL_REDIRECT=None,
+        ):
+            site_middleware = middleware.SiteMiddleware()
+            self.assertFalse(site_middleware.is_io_free())
+
+            def location(url):
+                response = site_middleware.process_request(self.request_from_url(url))
+                return response and response['Location']
+
+            self.assertEqual(location('http://default.io/'), 'http://www.default.com/')
+            self.assertEqual(location('http://default.com/'), 'http://www.default.com/')
+            self.assertIsNone(location('http://other.com/'))
+            with self.assertNumQueries(0):
+                # nothing changed
+                location('http://default.com/')
+
+            SiteDomain.objects.create(site=site_2, domain='other.com', type=SiteDomain.REDIRECT)
+            SiteDomain.objects.create(site=site_2, domain='*.other.com')
+            self.assertEqual(location('http://other.com/'), 'http://www.other.com/')
+            self.assertIsNone(location('http://shop.other.com/'))
+
+            SiteDomain.objects.filter(domain='default.com').delete()
+            self.assertIsNone(location('http://default.com/'))
+
+    def test_database_domains_invalid(self):
+        Site.objects.all().delete()
+        site_1 = Site.objects.create(id=1, name='Site 1', domain='www.default.com')
+        SiteDomain.objects.create(site=site_1, domain='^[a-z+$', type=SiteDomain.REDIRECT)
+        loader.logger.disabled = True
+        self.addCleanup(setattr, loader.logger, 'disabled', False)
+        domains = {1: {'domain': 'www.default.com', 'redirects': [re.compile(r'^[a-z]+\.default\.io$')]}}
+        with self.settings(
+            ALDRYN_SITES_DOMAINS=domains,
+            ALDRYN_SITES_DATABASE_DOMAINS=True,
+            SECURE_SSL_REDIRECT=None,
+        ):
+            site_middleware = middleware.SiteMiddleware()
+        # the invalid row is logged and the rules of the settings are used
+        response = site_middleware.process_request(self.request_from_url('http://foo.default.io/'))
+        self.assertEqual(response['Location'], 'http://www.default.com/')
+
+        SiteDomain.objects.filter(site=site_1).update(domain='default.com')
+        config = loader.get_domains(domains)
+        self.assertEqual(config[1]['redirects'], [domains[1]['redirects'][0], 'default.com'])
+        self.assertEqual(len(domains[1]['redirects']), 1)
+
+    def test_reload(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'domains.json')
+
+        def write_domains(redirects):
+            with open(path, 'w') as f:
+                json.dump({'1': {'domain': 'www.default.com', 'redirects': redirects}}, f)
+
+        write_domains(['default.com'])
+        with self.settings(
+            ALDRYN_SITES_DOMAINS_FILE=path,
+            ALDRYN_SITES_RELOAD_INTERVAL=0,
+            SECURE_SSL_REDIRECT=None,
+        ):
+            site_middleware = middleware.SiteMiddleware()
+
+        def location(url):
+            response = site_middleware.process_request(self.request_from_url(url))
+            return response and response['Location']
+
+        self.assertEqual(location('http://default.com/'), 'http://www.default.com/')
+        self.assertIsNone(location('http://default.io/'))
+
+        # changes to the file are loaded in the background
+        write_domains(['default.io'])
+        os.utime(path, (0, 0))
+        old_router = site_middleware.router
+        self.assertEqual(location('http://default.com/'), 'http://www.default.com/')
+        site_middleware.loader.reloading.join()
+        self.assertEqual(location('http://default.io/'), 'http://www.default.com/')
+        self.assertIsNone(location('http://default.com/'))
+        self.assertIsNot(site_middleware.router, old_router)
+
+        # a broken file keeps the current rules
+        loader.logger.disabled = True
+        self.addCleanup(setattr, loader.logger, 'disabled', False)
+        with open(path, 'w') as f:
+            f.write('{"1": {"aliases": []}}')
+        os.utime(path, (1, 1))
+        location('http://default.io/')
+        site_middleware.loader.reloading.join()
+        self.assertEqual(location('http://default.io/'), 'http://www.default.com/')
+
+        # explicit reload
+        write_domains(['default.me'])
+        loader.reload()
+        self.assertEqual(location('http://default.me/'), 'http://www.default.com/')
+        # a broken file is logged by an explicit reload too
+        with open(path, 'w') as f:
+            f.write('{"1": {"aliases": []}}')
+        loader.reload()
+        self.assertEqual(location('http://default.me/'), 'http://www.default.com/')
+
+        # reload on a signal
+        write_domains(['default.ch'])
+        previous_handler = signal.getsignal(signal.SIGUSR1)
+        self.addCleanup(signal.signal, signal.SIGUSR1, previous_handler)
+        loader.install_signal_handler('SIGUSR1')
+        os.kill(os.getpid(), signal.SIGUSR1)
+        site_middleware.loader.reloading.join()
+        self.assertEqual(location('http://default.ch/'), 'http://www.default.com/')
+
+        # only the main thread can install signal handlers, ready() doesn't fail elsewhere
+        errors = []
+
+        def ready():
+            try:
+                with self.settings(ALDRYN_SITES_RELOAD_SIGNAL='SIGUSR1'):
+                    django_apps.get_app_config('aldryn_sites').ready()
+            except Exception as e:
+                errors.append(e)
+
+        apps.logger.disabled = True
+        self.addCleanup(setattr, apps.logger, 'disabled', False)
+        thread = threading.Thread(target=ready)
+        thread.start()
+        thread.join()
+        self.assertEqual(errors, [])
@@ -2,14 +2,17 @@
 from __future__ import unicode_literals, absolute_import
 import re
 from django.conf import settings
+from django.contrib.sites import models as sites_models
 from django.contrib.sites.models import Site
-import yurl
+from django.core.cache import cache, caches
+from django.db import DatabaseError, transaction
 
 
 # global variable so we don't do this too often.
-# I wish there were an "application ready" signal.
 _has_set_site_names = False
 
+SYNC_LOCK_KEY = 'aldryn_sites:sync_lock'
+
 
 def set_site_names(force=False):
     global _has_set_site_names
@@ -17,23 +20,172 @@ def set_site_names(force=False):
         return
 
     _has_set_site_names = True
-    sites = {site.id: site for site in Site.objects.all()}
-    for site_id, site_config in settings.ALDRYN_SITES_DOMAINS.items():
+    if not force and prewarm_site_cache_from_shared_cache():
+        # another process synced the same config already
+        return
+    sync_sites_once()
+
+
+def sync_sites_once(domains=None, timeout=60):
+    """
+    Like ``sync_sites``, but skips the sync if another process is syncing at
+    the same time. The lock is kept in the default cache, so it only works
+    across processes with a cache that is shared between them.
+    :param timeout: seconds after which the lock expires, in case the process
+                    holding it died
+    :return: a ``(created, updated)`` tuple, or None if the sync was skipped
+    """
+    if not cache.add(SYNC_LOCK_KEY, True, timeout):
+        return None
+    try:
+        return sync_sites(domains)
+    finally:
+        cache.delete(SYNC_LOCK_KEY)
+
+
+SITES_CACHE_KEY = 'aldryn_sites:sites'
+
+
+def get_shared_site_cache():
+    """
+    :return: the cache in ALDRYN_SITES_SITE_CACHE, or None
+    """
+    alias = getattr(settings, 'ALDRYN_SITES_SITE_CACHE', None)
+    if not alias:
+        return None
+    return caches[alias]
+
+
+def clear_shared_site_cache():
+    shared_cache = get_shared_site_cache()
+    if shared_cache is not None:
+        shared_cache.delete(SITES_CACHE_KEY)
+
+
+def fill_site_cache(sites):
+    for site_id, site in sites.items():
+        sites_models.SITE_CACHE[site_id] = site
+        sites_models.SITE_CACHE[site.domain] = site
+
+
+def prewarm_site_cache(sites):
+    """
+    Fills the cache of ``django.contrib.sites`` (used by
+    ``Site.objects.get_current()``) with ``sites``, by id and by domain, and
+    stores them in the shared cache (ALDRYN_SITES_SITE_CACHE) if there is one.
+    :param sites: a dict of site id to Site object
+    """
+    fill_site_cache(sites)
+    shared_cache = get_shared_site_cache()
+    if shared_cache is not None:
+        shared_cache.set(SITES_CACHE_KEY, sites, None)
+
+
+def prewarm_site_cache_from_shared_cache(domains=None):
+    """
+    Fills the cache of ``django.contrib.sites`` from the shared cache without
+    a query, if it has all sites of ``domains`` (default:
+    ``settings.ALDRYN_SITES_DOMAINS``) with their configured domain.
+    :return: whether the shared cache was up to date
+    """
+    shared_cache = get_shared_site_cache()
+    if shared_cache is None:
+        return False
+    if domains is None:
+        domains = settings.ALDRYN_SITES_DOMAINS
+    sites = shared_cache.get(SITES_CACHE_KEY)
+    if not sites:
+        return False
+    for site_id, site_config in domains.items():
+        site = sites.get(site_id)
+        if site is None or site.domain != site_config['domain']:
+            return False
+    fill_site_cache(sites)
+    return True
+
+
+def prewarm_site_cache_from_database(domains=None):
+    """
+    Fills the cache of ``django.contrib.sites`` with the sites of ``domains``
+    (default: ``settings.ALDRYN_SITES_DOMAINS``) with a single query, without
+    syncing them.
+    :return: whether the sites could be loaded
+    """
+    if domains is None:
+        domains = settings.ALDRYN_SITES_DOMAINS
+    try:
+        sites = Site.objects.in_bulk(list(domains.keys()))
+    except DatabaseError:
+        # e.g. not migrated yet
+        return False
+    prewarm_site_cache(sites)
+    return True
+
+
+def get_site_changes(domains=None, sites=None):
+    """
+    Compares ``domains`` (default: ``settings.ALDRYN_SITES_DOMAINS``) to the
+    Site table with a single query.
+    Existing sites only get their domain updated, the name is only set for
+    new sites.
+    :param sites: a dict of site id to Site object, if they are loaded already
+    :return: a ``(created, updated)`` tuple of lists of unsaved Site objects
+    """
+    if domains is None:
+        domains = settings.ALDRYN_SITES_DOMAINS
+    if sites is None:
+        sites = Site.objects.in_bulk(list(domains.keys()))
+    created = []
+    updated = []
+    for site_id, site_config in sorted(domains.items()):
         config_name = site_config.get('name', None)
         config_domain = site_config['domain']
 
-        if site_id not in sites.keys():
-            sites[site_id] = Site.objects.create(
+        if site_id not in sites:
+            created.append(Site(
                 id=site_id,
                 name=config_name or config_domain,
                 domain=config_domain,
-            )
+            ))
         else:
             site = sites[site_id]
             if site.domain != config_domain:
                 # domain needs to be updated
                 site.domain = config_domain
-                site.save()
+                updated.append(site)
+    return created, updated
+
+
+def sync_sites(domains=None, dry_run=False):
+    """
+    Creates and updates the Site table from ``domains`` (default:
+    ``settings.ALDRYN_SITES_DOMAINS``) in bulk, in a single transaction.
+    Afterwards the cache of ``django.contrib.sites`` is filled with all
+    configured sites (see ``prewarm_site_cache``).
+    :return: a ``(created, updated)`` tuple of lists of Site objects
+    """
+    if domains is None:
+        domains = settings.ALDRYN_SITES_DOMAINS
+    with transaction.atomic():
+        sites = Site.objects.in_bulk(list(domains.keys()))
+        created, updated = get_site_changes(domains, sites)
+        if dry_run:
+            return created, updated
+        if created:
+            Site.objects.bulk_create(created)
+        if updated:
+            if hasattr(Site.objects, 'bulk_update'):
+                Site.objects.bulk_update(updated, ['domain'])
+            else:
+                # Django < 2.2
+                for site in updated:
+                    site.save(update_fields=['domain'])
+    if created or updated:
+        # bulk operations don't send the signals that usually clear the cache
+        Site.objects.clear_cache()
+    sites.update((site.id, site) for site in created)
+    prewarm_site_cache(sites)
+    return created, updated
 
 
 def get_redirect_url(current_url, config, https=None):
@@ -44,46 +196,47 @@ def get_redirect_url(current_url, config, https=None):
     :param config: redirect configuration for this url
     :param want_https: whether redirects should go to https (None keeps the current scheme)
     :return: None for no redirect or an url to redirect to
+
+    The compiled ``config`` is kept for the next calls with the same
+    ``config`` object, unless it was changed since. Use
+    ``aldryn_sites.canonical.canonicalize_urls`` for many urls.
     """
-    primary_domain = config['domain']
-    domains = set(config.get('aliases', [])) | set((primary_domain,))
-    domain_patterns = compile_regexes(domains)
-    redirect_domains = set(config.get('redirects', []))
-    redirect_domain_patterns = compile_regexes(redirect_domains)
-    url = yurl.URL(current_url)
-    if https is None:
-        target_scheme = url.scheme
-    else:
-        target_scheme = 'https' if https else 'http'
-    redirect_url = None
-    if url.is_host_ip() or url.is_host_ipv4():
-        # don't redirect for ips
-        return
-    if url.host in domains and url.scheme == target_scheme:
-        # exact host and scheme match: Nothing to do
-        return
-    if url.host in domains and url.scheme != target_scheme:
-        # exact alias match, but scheme mismatch: redirect to changed scheme
-        redirect_url = url.replace(scheme=target_scheme)
-    elif url.host in redirect_domains:
-        # exact redirect match: redirect
-        redirect_url = url.replace(scheme=target_scheme, host=primary_domain)
-    elif url.host in domains:
-        # exact alias match: nothing to do
-        return
-    elif match_any(redirect_domain_patterns, url.host):
-        # pattern redirect match: redirect
-        redirect_url = url.replace(scheme=target_scheme, host=primary_domain)
-    elif match_any(domain_patterns, url.host):
-        # pattern alias match
-        if url.scheme != target_scheme:
-            # pattern alias match and scheme mismatch: redirect
-            redirect_url = url.replace(scheme=target_scheme)
-        else:
-            return
+    return get_config_router(config, https).get_redirect_url(current_url)
+
+
+# routers compiled by get_redirect_url, cleared when full
+_config_routers = {}
+_config_routers_size = 100
+
+
+def get_config_router(config, https=None):
+    """
+    :return: a ``SiteRouter`` for ``config``, compiled once per ``config``
+             object (and compiled again if it changed)
+    """
+    key = (id(config), https)
+    cached = _config_routers.get(key)
+    # the config itself is kept, so its id isn't reused by another object
+    if cached is not None and cached[0] is config and cached[1] == config:
+        return cached[2]
+    from .router import SiteRouter
+    router = SiteRouter(config, https=https)
+    if len(_config_routers) >= _config_routers_size:
+        _config_routers.clear()
+    _config_routers[key] = (config, copy_config(config), router)
+    return router
 
-    if redirect_url:
-        return '{}'.format(redirect_url)
+
+def copy_config(config):
+    """
+    :return: a copy of the config of a site that compares unequal to it once
+             it was changed. Only the lists are copied, not their entries
+             (pre-compiled regexes can't be copied on all Python versions).
+    """
+    return dict(
+        (key, type(value)(value) if isinstance(value, (list, tuple, set, frozenset)) else value)
+        for key, value in config.items()
+    )
 
 
 def get_all_domains(config):
@@ -97,6 +250,97 @@ def get_all_domains(config):
     return domains
 
 
+DEFAULT_PORTS = {'http': '80', 'https': '443'}
+
+# normalize_host results, cleared when full
+_normalized_hosts = {}
+_normalized_hosts_size = 10000
+
+
+def normalize_host(host):
+    """
+    :return: ``host`` lowercased, without a trailing dot and with
+             internationalized labels as A-labels (``xn--...``). Results are
+             memoised.
+    """
+    normalized = _normalized_hosts.get(host)
+    if normalized is not None:
+        return normalized
+    normalized = get_normalized_host(host)
+    if len(_normalized_hosts) >= _normalized_hosts_size:
+        # random hosts must not fill up the memory
+        _normalized_hosts.clear()
+    _normalized_hosts[host] = normalized
+    return normalized
+
+
+def get_normalized_host(host):
+    """
+    Like ``normalize_host``, but not memoised (for configs, which would
+    only push the requested hosts out). Returns ``host`` itself if it is
+    normalized already, so the router shares the strings of the config.
+    """
+    normalized = host.lower()
+    if normalized.endswith('.'):
+        normalized = normalized[:-1]
+    try:
+        normalized.encode('ascii')
+    except UnicodeError:
+        try:
+            normalized = normalized.encode('idna').decode('ascii')
+        except UnicodeError:
+            # not a valid domain name, it can't match anything anyway
+            pass
+    if normalized == host:
+        return host
+    return normalized
+
+
+def normalize_port(port, scheme):
+    """
+    :return: ``port``, or ``''`` if it is the default port of ``scheme``
+    """
+    if port and DEFAULT_PORTS.get(scheme) == port:
+        return ''
+    return port
+
+
+def split_host(host):
+    """
+    Splits a (validated) ``Host`` header value into host and port.
+    """
+    if host.endswith(']'):
+        # IPv6 address without a port
+        return host, ''
+    domain, _, port = host.rpartition(':')
+    if not domain:
+        return port, ''
+    return domain, port
+
+
+def is_ip_address(host):
+    """
+    Cheap check for IPv4 and (bracketed) IPv6 addresses, as they appear in
+    the ``Host`` header.
+    """
+    if host.startswith('[') or ':' in host:
+        return True
+    parts = host.split('.')
+    return len(parts) == 4 and all(part.isdigit() for part in parts)
+
+
+def build_url(scheme, host, port, full_path):
+    if port:
+        return '{}://{}:{}{}'.format(scheme, host, port, full_path)
+    return '{}://{}{}'.format(scheme, host, full_path)
+
+
+def add_query_string(url, query_string):
+    if not query_string or '?' in url:
+        return url
+    return '{}?{}'.format(url, query_string)
+
+
 def compile_regexes(pattern_strings):
     return [
         (re.compile(pattern_string) if not hasattr(pattern_string, 'match') else pattern_string)
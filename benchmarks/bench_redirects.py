@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for redirect resolution and SiteMiddleware overhead.
+
+Runs offline against an in-memory sqlite database:
+
+    python benchmarks/bench_redirects.py
+    python benchmarks/bench_redirects.py --sizes 10 1000 --pattern-shares 0 0.1 --save baseline.json
+    python benchmarks/bench_redirects.py --compare baseline.json
+
+For every config size (number of domains) and share of regex patterns, each
+hit type is measured through ``utils.get_redirect_url`` and through
+``SiteMiddleware.process_request``. Results are reported as ops/sec and
+per-call latency percentiles in microseconds.
+
+The footprint of the compiled rules is reported per config size as well:
+the time to build a ``SitesRouter`` for the domains spread over several
+sites, and the memory it takes (measured with ``tracemalloc``, without the
+config itself).
+"""
+from __future__ import unicode_literals, absolute_import, print_function, division
+import argparse
+import json
+import os
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2
+    tracemalloc = None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import django  # NOQA
+from django.conf import settings  # NOQA
+
+urlpatterns = []
+
+settings.configure(
+    DEBUG=False,
+    ROOT_URLCONF=__name__,
+    SECRET_KEY='benchmark',
+    ALLOWED_HOSTS=['*'],
+    SITE_ID=1,
+    DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+    INSTALLED_APPS=['django.contrib.sites', 'aldryn_sites'],
+    ALDRYN_SITES_DOMAINS={1: {'domain': 'www.example.com'}},
+)
+django.setup()
+
+from django.core.management import call_command  # NOQA
+from django.test import RequestFactory  # NOQA
+from django.test.utils import override_settings  # NOQA
+
+from aldryn_sites import middleware, utils  # NOQA
+from aldryn_sites.router import SitesRouter  # NOQA
+
+
+HIT_TYPES = ('exact', 'exact_redirect', 'pattern_redirect', 'miss', 'ip')
+PERCENTILES = (50, 90, 99)
+
+
+def build_config(size, pattern_share):
+    """
+    :return: a site config with ``size`` domains, ``pattern_share`` of them
+             regexes, and a ``{hit_type: host}`` dict to request
+    """
+    patterns = int(size * pattern_share)
+    exact = size - patterns
+    aliases = ['alias{}.example.com'.format(i) for i in range(exact // 2)]
+    redirects = ['redirect{}.example.com'.format(i) for i in range(exact - len(aliases))]
+    alias_patterns = [r'^[a-z0-9-]+\.alias{}\.example\.com$'.format(i) for i in range(patterns // 2)]
+    redirect_patterns = [
+        r'^[a-z0-9-]+\.redirect{}\.example\.com$'.format(i)
+        for i in range(patterns - len(alias_patterns))
+    ]
+    config = {
+        'domain': 'www.example.com',
+        'aliases': aliases + alias_patterns,
+        'redirects': redirects + redirect_patterns,
+    }
+    hosts = {
+        'exact': aliases[-1] if aliases else 'www.example.com',
+        'exact_redirect': redirects[-1] if redirects else None,
+        # the last pattern is the worst case for a linear scan
+        'pattern_redirect': 'foo.redirect{}.example.com'.format(len(redirect_patterns) - 1)
+        if redirect_patterns else None,
+        'miss': 'unknown.example.org',
+        'ip': '10.0.0.1',
+    }
+    return config, hosts
+
+
+def build_sites_config(size, pattern_share, sites=10):
+    """
+    :return: ``ALDRYN_SITES_DOMAINS`` with ``size`` domains spread over
+             ``sites`` sites
+    """
+    domains = {}
+    for site_id in range(1, sites + 1):
+        config = build_config(size // sites, pattern_share)[0]
+        name = 'site{}'.format(site_id)
+        domains[site_id] = {
+            'domain': config['domain'].replace('example', name),
+            'aliases': [entry.replace('example', name) for entry in config['aliases']],
+            'redirects': [entry.replace('example', name) for entry in config['redirects']],
+        }
+    return domains
+
+
+def measure_footprint(size, pattern_share, repeat=3):
+    """
+    :return: a dict with the fastest startup (building the ``SitesRouter``)
+             in milliseconds, the memory the router takes in kilobytes and
+             the number of hosts it indexed
+    """
+    timer = time.perf_counter if hasattr(time, 'perf_counter') else time.time
+    domains = build_sites_config(size, pattern_share)
+    durations = []
+    for _ in range(repeat):
+        start = timer()
+        SitesRouter(domains)
+        durations.append(timer() - start)
+    result = {'startup_ms': min(durations) * 1e3}
+    if tracemalloc is not None:
+        tracemalloc.start()
+        router = SitesRouter(domains)
+        result['memory_kb'] = tracemalloc.get_traced_memory()[0] / 1024.0
+        tracemalloc.stop()
+        # also keeps the router alive until it is measured
+        result['hosts'] = len(router.hosts)
+    return result
+
+
+def print_footprint(key, result, baseline=None):
+    line = '{:<70} startup={:>10.1f}ms'.format(key, result['startup_ms'])
+    if 'memory_kb' in result:
+        line += ' memory={:>10.0f}kB'.format(result['memory_kb'])
+    if baseline:
+        line += ' {:+7.1f}%'.format((result['startup_ms'] / baseline['startup_ms'] - 1) * 100)
+        if 'memory_kb' in result and 'memory_kb' in baseline:
+            line += ' {:+7.1f}%'.format((result['memory_kb'] / baseline['memory_kb'] - 1) * 100)
+    print(line)
+
+
+def measure(func, min_time, max_calls):
+    """
+    Calls ``func`` until ``min_time`` seconds or ``max_calls`` calls have
+    passed.
+    :return: a dict with ops/sec and latency percentiles in microseconds
+    """
+    timer = time.perf_counter if hasattr(time, 'perf_counter') else time.time
+    func()  # warm up
+    durations = []
+    started = timer()
+    while len(durations) < max_calls and (timer() - started) < min_time:
+        start = timer()
+        func()
+        durations.append(timer() - start)
+    durations.sort()
+    total = sum(durations)
+    result = {
+        'calls': len(durations),
+        'ops_per_sec': len(durations) / total if total else 0.0,
+    }
+    for percentile in PERCENTILES:
+        index = min(len(durations) - 1, int(len(durations) * percentile / 100))
+        result['p{}_us'.format(percentile)] = durations[index] * 1e6
+    return result
+
+
+def run(sizes, pattern_shares, min_time, max_calls):
+    factory = RequestFactory()
+    results = {}
+    for size in sizes:
+        for pattern_share in pattern_shares:
+            key = 'footprint size={} patterns={}'.format(size, pattern_share)
+            results[key] = measure_footprint(size, pattern_share)
+            print_footprint(key, results[key])
+            config, hosts = build_config(size, pattern_share)
+            with override_settings(
+                ALDRYN_SITES_DOMAINS={1: config},
+                SECURE_SSL_REDIRECT=None,
+            ):
+                site_middleware = middleware.SiteMiddleware()
+            for hit_type in HIT_TYPES:
+                host = hosts[hit_type]
+                if host is None:
+                    continue
+                url = 'http://{}/path/?query=1'.format(host)
+                request = factory.get('/path/?query=1', HTTP_HOST=host)
+                cases = (
+                    ('get_redirect_url', lambda: utils.get_redirect_url(url, config=config)),
+                    ('process_request', lambda: site_middleware.process_request(request)),
+                )
+                for name, func in cases:
+                    key = '{} size={} patterns={} {}'.format(name, size, pattern_share, hit_type)
+                    results[key] = measure(func, min_time, max_calls)
+                    print_result(key, results[key])
+    return results
+
+
+def print_result(key, result, baseline=None):
+    line = '{:<70} {:>12,.0f} ops/s {}'.format(
+        key,
+        result['ops_per_sec'],
+        ' '.join('p{}={:>9.1f}us'.format(p, result['p{}_us'.format(p)]) for p in PERCENTILES),
+    )
+    if baseline:
+        line += ' {:+7.1f}%'.format((result['ops_per_sec'] / baseline['ops_per_sec'] - 1) * 100)
+    print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', nargs='+', type=int, default=[10, 100, 1000, 10000],
+                        help='number of domains in the config')
+    parser.add_argument('--pattern-shares', nargs='+', type=float, default=[0, 0.1, 0.5],
+                        help='share of domains that are regexes')
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='seconds to spend on each case')
+    parser.add_argument('--max-calls', type=int, default=100000,
+                        help='maximum number of calls per case')
+    parser.add_argument('--save', help='write the results to this json file')
+    parser.add_argument('--compare', help='compare the results to a json file written by --save')
+    args = parser.parse_args(argv)
+
+    call_command('migrate', verbosity=0)
+    results = run(args.sizes, args.pattern_shares, args.min_time, args.max_calls)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print('\ncompared to {}:'.format(args.compare))
+        for key, result in sorted(results.items()):
+            if key not in baseline:
+                continue
+            if key.startswith('footprint '):
+                print_footprint(key, result, baseline[key])
+            else:
+                print_result(key, result, baseline[key])
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()